@@ -6,8 +6,11 @@
     :license: BSD, see LICENSE for more details.
 """
 from trytond.pool import Pool
-from product import Product, Template, ProductAttribute
+from product import Product, Template, ProductAttribute, Category, TreeNode
 from website import Website
+from backlog import IndexBacklog, DocumentHash
+from configuration import Configuration
+from price_list import PriceList, PriceListLine
 
 
 def register():
@@ -15,6 +18,13 @@ def register():
         Product,
         ProductAttribute,
         Template,
+        Category,
+        TreeNode,
         Website,
+        IndexBacklog,
+        DocumentHash,
+        Configuration,
+        PriceList,
+        PriceListLine,
         module='nereid_webshop_elastic_search', type_='model'
     )
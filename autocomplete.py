@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+    autocomplete.py
+
+    An in-process index of the prefixes of the product names, which answers
+    the autocompletion of the webshop without a request to elasticsearch.
+    It is enabled with the `elastic_search_prefix_index` option of the
+    configuration file.
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import unicodedata
+from bisect import bisect_left
+from threading import Lock, Thread
+
+
+def normalize(text):
+    """
+    Return the text in lower case, without accents and with single spaces,
+    as it is stored in and looked up from the prefix index.
+    """
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    text = u''.join(
+        char for char in unicodedata.normalize('NFKD', text)
+        if not unicodedata.combining(char)
+    )
+    return u' '.join(text.lower().split())
+
+
+class PrefixIndex(object):
+    """
+    A sorted array of the normalized inputs of the `suggest` field of the
+    product documents, searched by bisection.
+
+    The index is built from a snapshot of all the documents, then refreshed
+    with the documents indexed since the previous refresh, which elastic
+    search returns by their `_timestamp`. The documents deleted from elastic
+    search are only removed by the next full refresh, every
+    `full_refresh_interval` seconds.
+
+    The webshop refreshes the index in a background thread (see
+    `refresh_in_background`), so that no request waits for the documents to
+    be read.
+
+    >>> index = PrefixIndex(conn, 'webshop', 'product_product')
+    >>> index.refresh(version=1)
+    >>> index.search('blue sh')
+    [{'id': 1, 'display_name': u'Blue Shirt', 'uri': u'blue-shirt'}]
+    """
+
+    #: Seconds between two full refreshes
+    full_refresh_interval = 3600
+
+    #: Seconds subtracted from the time of the last refresh when fetching the
+    #: documents indexed since, for the documents not yet searchable then
+    #: and the difference between the clocks
+    refresh_margin = 60
+
+    #: Minimum number of seconds between two refreshes, as the version of
+    #: the index changes with every batch of the backlog
+    min_refresh_interval = 5
+
+    #: Number of documents read per scroll request
+    scroll_size = 500
+
+    def __init__(self, conn, index_name, doc_type):
+        """
+        :param conn: The `~pyes.es.ES` connection
+        :param index_name: Name of the index (or alias) to read from
+        :param doc_type: Name of the document type of the products
+        """
+        self.conn = conn
+        self.index_name = index_name
+        self.doc_type = doc_type
+
+        #: The version of the index the prefix index was refreshed to
+        self.version = None
+        self.refreshed_at = None
+        self.built_at = None
+
+        #: The sorted inputs, the ids of their products and the products by
+        #: id, replaced together by a refresh
+        self._state = ([], [], {})
+        self._lock = Lock()
+
+        #: The thread of the background refresh, see `refresh_in_background`
+        self._thread = None
+        self._thread_lock = Lock()
+
+    @property
+    def ready(self):
+        """
+        Tell if the index was built, an empty index has no match.
+        """
+        return self.version is not None
+
+    def search(self, phrase, size=5):
+        """
+        Return the products with an input starting with the phrase, as
+        dictionaries with their `id`, `display_name` and `uri`, in the order
+        of their inputs.
+        """
+        prefix = normalize(phrase)
+        if not prefix:
+            return []
+        keys, ids, products = self._state
+
+        results, seen = [], set()
+        position = bisect_left(keys, prefix)
+        while position < len(keys) and len(results) < size:
+            if not keys[position].startswith(prefix):
+                break
+            product_id = ids[position]
+            if product_id not in seen and product_id in products:
+                seen.add(product_id)
+                name, uri = products[product_id][1:]
+                results.append({
+                    'id': product_id,
+                    'display_name': name,
+                    'uri': uri,
+                })
+            position += 1
+        return results
+
+    def needs_refresh(self, version):
+        """
+        Tell if the prefix index should be refreshed to the given version of
+        the elasticsearch index.
+        """
+        return self.version != version and (
+            self.refreshed_at is None or
+            time.time() - self.refreshed_at >= self.min_refresh_interval
+        )
+
+    def refresh(self, version):
+        """
+        Bring the prefix index up to date with the elasticsearch index, of
+        the given version. A full refresh is done the first time and every
+        `full_refresh_interval` seconds, otherwise only the documents
+        indexed since the previous refresh are read.
+
+        Nothing is done if another thread is refreshing the index, the
+        searches meanwhile use the previous state of the index.
+        """
+        if not self._lock.acquire(False):
+            return
+        try:
+            if not self.needs_refresh(version):
+                return
+            started_at = time.time()
+
+            if self.built_at is None or \
+                    started_at - self.built_at > self.full_refresh_interval:
+                products = {}
+                for product_id, source in self._scan():
+                    self._add(products, product_id, source)
+                self.built_at = started_at
+            else:
+                products = dict(self._state[2])
+                since = int((self.refreshed_at - self.refresh_margin) * 1000)
+                for product_id, source in self._scan({
+                    'range': {'_timestamp': {'gte': since}},
+                }):
+                    products.pop(product_id, None)
+                    self._add(products, product_id, source)
+
+            entries = sorted(
+                (key, product_id)
+                for product_id, (inputs, _, _) in products.iteritems()
+                for key in inputs
+            )
+            # Searches read the state without the lock, so the arrays are
+            # published together, in a single assignment
+            self._state = (
+                [key for key, _ in entries],
+                [product_id for _, product_id in entries],
+                products,
+            )
+
+            self.version = version
+            self.refreshed_at = started_at
+        finally:
+            self._lock.release()
+
+    def refresh_in_background(self, version, logger):
+        """
+        Start a thread refreshing the prefix index to the given version,
+        unless it is up to date or a background refresh is running already.
+        The errors of the refresh are logged with the given logger.
+
+        Returns the thread started, if any.
+        """
+        with self._thread_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return None
+            if not self.needs_refresh(version):
+                return None
+            self._thread = Thread(
+                target=self._refresh_logged, args=(version, logger),
+                name='prefix-index-refresh'
+            )
+            self._thread.daemon = True
+            self._thread.start()
+            return self._thread
+
+    def wait_refresh(self, timeout=None):
+        """
+        Wait for the background refresh to finish, if one is running.
+        """
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _refresh_logged(self, version, logger):
+        try:
+            self.refresh(version)
+        except Exception:
+            logger.warning(
+                "Could not refresh the autocompletion prefix index",
+                exc_info=True
+            )
+
+    @staticmethod
+    def _add(products, product_id, source):
+        suggest = source.get('suggest')
+        if not suggest or not source.get('uri'):
+            # Inactive or not displayed on the webshop
+            return
+        products[product_id] = (
+            set(normalize(text) for text in suggest['input']),
+            suggest.get('output') or source.get('name'),
+            source['uri'],
+        )
+
+    def _scan(self, filter=None):
+        """
+        Yield the id and the source of the documents matching the filter,
+        with only the fields used by the prefix index, using a scroll.
+        """
+        body = {
+            '_source': ['name', 'uri', 'suggest'],
+            'query': {'match_all': {}},
+        }
+        if filter is not None:
+            body['query'] = {
+                'filtered': {'query': body['query'], 'filter': filter},
+            }
+
+        response = self.conn._send_request(
+            'GET', '/%s/%s/_search' % (self.index_name, self.doc_type), body,
+            params={'scroll': '1m', 'size': self.scroll_size}
+        )
+        while response['hits']['hits']:
+            for hit in response['hits']['hits']:
+                yield int(hit['_id']), hit['_source']
+            response = self.conn._send_request(
+                'GET', '/_search/scroll', response['_scroll_id'],
+                params={'scroll': '1m'}
+            )
+
+
+#: The prefix indices of the process, by database name
+_indices = {}
+_indices_lock = Lock()
+
+
+def get_prefix_index(database_name, factory):
+    """
+    Return the prefix index of the products of the database, created empty
+    by calling `factory` the first time.
+    """
+    with _indices_lock:
+        index = _indices.get(database_name)
+        if index is None:
+            index = _indices[database_name] = factory()
+        return index
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+    backlog.py
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+
+from trytond import backend
+from trytond.model import ModelSQL, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+from indexer import BulkIndexer, chunks
+
+__metaclass__ = PoolMeta
+__all__ = ['IndexBacklog', 'DocumentHash']
+
+#: Records written up to this long before a given time may not be visible at
+#: that time, as their transaction may not have been committed yet.
+CHANGES_MARGIN = timedelta(minutes=5)
+
+Entry = namedtuple('Entry', ['id', 'record_model', 'record_id'])
+
+
+class IndexBacklog:
+    __name__ = 'elasticsearch.index_backlog'
+
+    @classmethod
+    def create_from_record(cls, record):
+        """
+        Add a record to the backlog, unless it is already pending.
+        """
+        return cls.create_from_records([record])
+
+    @classmethod
+    def create_from_records(cls, records):
+        """
+        Add the given records to the backlog, unless they are already pending
+        in the current transaction.
+
+        The documents are built from the state of the records at the time the
+        backlog is processed, so a single pending entry per record is enough
+        however many times it was written in between (last write wins).
+        """
+        keys = set((record.__name__, record.id) for record in records)
+        if not keys:
+            return []
+
+        keys -= cls._get_pending_keys(keys)
+        return cls.create([{
+            'record_model': model_name,
+            'record_id': record_id,
+        } for model_name, record_id in sorted(keys)])
+
+    @staticmethod
+    def _get_keys_domain(keys):
+        """
+        Return a domain matching the backlog entries of the given
+        (model name, record id) keys.
+        """
+        record_ids_by_model = defaultdict(list)
+        for model_name, record_id in keys:
+            record_ids_by_model[model_name].append(record_id)
+
+        return ['OR'] + [[
+            ('record_model', '=', model_name),
+            ('record_id', 'in', record_ids),
+        ] for model_name, record_ids in record_ids_by_model.iteritems()]
+
+    @classmethod
+    def _get_pending_keys(cls, keys):
+        """
+        Return the subset of the given (model name, record id) keys which
+        already have an entry created by the current transaction.
+
+        The entries of other transactions are not reused: a drainer may
+        process them before this transaction is committed, which would lose
+        its changes, and locking them would make this transaction fail on
+        PostgreSQL when a drainer deletes them first. The drainers coalesce
+        such duplicates instead (see `lock_batch`).
+        """
+        created_ids = Transaction().create_records.get(cls.__name__)
+        if not created_ids:
+            return set()
+        return set(
+            (item.record_model, item.record_id)
+            for item in cls.search([
+                ('id', 'in', list(created_ids)),
+                cls._get_keys_domain(keys),
+            ])
+        )
+
+    @classmethod
+    def _lock(cls, ids):
+        """
+        Lock the backlog entries of the given ids until the end of the
+        transaction, and return the ids of those which were not locked by
+        another drainer.
+
+        Only PostgreSQL has row locks, every id is returned on the other
+        backends.
+        """
+        if not ids or backend.name() != 'postgresql':
+            return ids
+
+        cursor = Transaction().cursor
+        locked_ids = []
+        for sub_ids in chunks(ids, cursor.IN_MAX):
+            cursor.execute(
+                'SELECT id FROM "%s" WHERE id IN (%s) '
+                'FOR UPDATE SKIP LOCKED' % (
+                    cls._table, ','.join(['%s'] * len(sub_ids))
+                ), sub_ids
+            )
+            locked_ids.extend(row[0] for row in cursor.fetchall())
+        return locked_ids
+
+    @classmethod
+    def lock_batch(cls, batch_size):
+        """
+        Lock up to `batch_size` entries, the most recent first, along with
+        the other entries of the same records, and return the list of the
+        locked entries.
+
+        On PostgreSQL the entries locked by another drainer are skipped
+        (`FOR UPDATE SKIP LOCKED`), so concurrent drainers get disjoint
+        batches without waiting on each other. The locks are released when
+        the transaction ends, and the entries which were not deleted are
+        then processed by the next drainer, whether the transaction was
+        committed or not. The other backends lock the whole database on the
+        first write, so a single drainer should run at a time.
+        """
+        query = 'SELECT id FROM "%s" ORDER BY id DESC LIMIT %%s' % cls._table
+        if backend.name() == 'postgresql':
+            query += ' FOR UPDATE SKIP LOCKED'
+
+        cursor = Transaction().cursor
+        cursor.execute(query, (batch_size,))
+        items = cls.browse([row[0] for row in cursor.fetchall()])
+        if not items:
+            return []
+
+        # Older entries of the records are processed with the batch
+        duplicates = cls.search([
+            ('id', 'not in', [item.id for item in items]),
+            cls._get_keys_domain(
+                set((item.record_model, item.record_id) for item in items)
+            ),
+        ])
+        items += cls.browse(cls._lock([item.id for item in duplicates]))
+        return [
+            Entry(item.id, item.record_model, item.record_id)
+            for item in items
+        ]
+
+    @classmethod
+    def sync_changes(cls):
+        """
+        Add to the backlog the products whose document may have changed since
+        the last synchronisation, and move the watermark forward.
+
+        This catches the changes which are not made through the methods
+        adding records to the backlog (like SQL updates or changes to
+        categories and tree nodes). The first synchronisation only sets the
+        watermark.
+        """
+        Configuration = Pool().get('elasticsearch.configuration')
+        Product = Pool().get('product.product')
+
+        config = Configuration(1)
+        now = datetime.now()
+
+        if config.sync_watermark:
+            cls.create_from_records(Product.search_elastic_search_changed(
+                config.sync_watermark - CHANGES_MARGIN
+            ))
+        Configuration.write([config], {'sync_watermark': now})
+
+    @classmethod
+    def update_index(cls, batch_size=100):
+        """
+        Update the remote elastic search index from the backlog and delete
+        the processed backlog entries.
+
+        The entries of a batch are grouped by model, so that all the records
+        of a model are serialized together and each record is indexed once
+        however many entries it has. Models providing an
+        `elastic_search_json_batch` classmethod (like `product.product`) are
+        serialized in one call per batch, and the documents are sent in
+        `_bulk` requests. Entries whose document could not be updated are
+        kept in the backlog for the next run.
+
+        Returns a dictionary of statistics on the run: the number of backlog
+        `entries` processed, of `documents` sent, of items `rejected` by
+        elasticsearch (even if a retry succeeded), of bulk `requests` and the
+        `request_time` spent in them, in seconds. The version of the index
+        (see `Configuration.get_index_version`) is incremented when
+        documents were sent.
+
+        Several drainers can run at the same time, as each of them locks a
+        disjoint batch of entries (see `lock_batch`).
+
+        :param batch_size: Number of backlog entries processed
+        """
+        Configuration = Pool().get('elasticsearch.configuration')
+
+        items = cls.lock_batch(batch_size)
+
+        record_ids_by_model = defaultdict(set)
+        for item in items:
+            record_ids_by_model[item.record_model].add(item.record_id)
+
+        stats = {
+            'entries': len(items), 'documents': 0, 'rejected': 0,
+            'requests': 0, 'request_time': 0.0,
+        }
+        failed_keys = set()
+        for model_name, record_ids in record_ids_by_model.iteritems():
+            indexer, failed_ids = cls._update_model_index(
+                model_name, record_ids
+            )
+            failed_keys.update(
+                (model_name, record_id) for record_id in failed_ids
+            )
+            stats['documents'] += indexer.succeeded + len(indexer.errors)
+            stats['rejected'] += indexer.rejected
+            stats['requests'] += indexer.requests
+            stats['request_time'] += indexer.request_time
+
+        cls.delete(cls.browse([
+            item.id for item in items
+            if (item.record_model, item.record_id) not in failed_keys
+        ]))
+
+        if stats['documents']:
+            Configuration.increment_index_version()
+        return stats
+
+    @classmethod
+    def _update_model_index(cls, model_name, record_ids):
+        """
+        Update the index for the backlog entries of the given model, and
+        return the `BulkIndexer` used and the set of the ids of the entries
+        which failed.
+
+        The entries of the models listed by
+        `product.product.get_elastic_search_partial_updates` update a part of
+        the documents of the related products. The records of every other
+        model are indexed, or removed from the index if they were deleted.
+        """
+        DocumentHash = Pool().get('elasticsearch.document_hash')
+        Product = Pool().get('product.product')
+
+        if model_name in Product.get_elastic_search_partial_updates():
+            indexer = BulkIndexer.from_config(Product.__name__)
+            product_ids = Product.elastic_search_update_partial(
+                model_name, record_ids, indexer
+            )
+            DocumentHash.forget(Product.__name__, product_ids)
+            failed_ids = record_ids if indexer.errors else set()
+        else:
+            indexer = BulkIndexer.from_config(model_name)
+            cls._index_records(indexer, model_name, record_ids)
+            failed_ids = indexer.failed_ids
+
+        cls._log_errors(indexer)
+        return indexer, failed_ids
+
+    @staticmethod
+    def _log_errors(indexer):
+        logger = Pool().get('elasticsearch.configuration').get_logger()
+
+        for error in indexer.errors:
+            logger.error(
+                "Could not %s %s %s in elasticsearch: %s" % (
+                    error['action'], indexer.doc_type, error['id'],
+                    error['error']
+                )
+            )
+
+    @classmethod
+    def _index_records(cls, indexer, model_name, record_ids):
+        """
+        Index the records of the given model which still exist and remove
+        the deleted ones from the index.
+
+        Documents identical to the ones last indexed into the same index
+        (according to their `elasticsearch.document_hash`) are not sent
+        again.
+
+        :param indexer: The `BulkIndexer` of the model's document type
+        """
+        DocumentHash = Pool().get('elasticsearch.document_hash')
+        Model = Pool().get(model_name)
+
+        records = Model.search([('id', 'in', list(record_ids))])
+
+        deleted_ids = record_ids - set(r.id for r in records)
+        for record_id in deleted_ids:
+            # Record may have been deleted
+            indexer.delete(record_id)
+
+        documents = dict(zip(
+            [r.id for r in records], cls._serialize(Model, records)
+        ))
+        digests = dict(
+            (record_id, indexer.digest(document))
+            for record_id, document in documents.iteritems()
+        )
+        index_key = indexer.index_key
+        if index_key is None:
+            # The index is created by the first documents sent to it
+            changed = digests.keys()
+        else:
+            changed = DocumentHash.filter_changed(
+                index_key, model_name, digests
+            )
+
+        for record_id in changed:
+            indexer.index(record_id, documents[record_id])
+        indexer.flush()
+
+        DocumentHash.forget(model_name, deleted_ids)
+        if index_key is not None:
+            DocumentHash.remember(index_key, model_name, dict(
+                (record_id, digests[record_id]) for record_id in changed
+                if record_id not in indexer.failed_ids
+            ))
+
+    @classmethod
+    def _serialize(cls, Model, records):
+        """
+        Return the list of documents of the given records
+        """
+        if hasattr(Model, 'elastic_search_json_batch'):
+            return Model.elastic_search_json_batch(records)
+        if hasattr(Model, 'elastic_search_json'):
+            return [record.elastic_search_json() for record in records]
+        return [cls._build_default_doc(record) for record in records]
+
+
+class DocumentHash(ModelSQL):
+    """
+    Elasticsearch Document Hash
+
+    The digest of the document last indexed for a record into an index,
+    which is used to skip sending documents which did not change.
+
+    The digests are kept per index (see `indexer.get_index_key`), so that an
+    index created again, restored or filled by other means starts without
+    digests and receives every document.
+    """
+    __name__ = 'elasticsearch.document_hash'
+
+    index_key = fields.Char('Index', select=True)
+    record_model = fields.Char('Record Model', required=True, select=True)
+    record_id = fields.Integer('Record ID', required=True, select=True)
+    digest = fields.Char('Digest', required=True)
+
+    @classmethod
+    def _search_records(cls, model_name, record_ids=None, index_key=None):
+        domain = [('record_model', '=', model_name)]
+        if record_ids is not None:
+            domain.append(('record_id', 'in', list(record_ids)))
+        if index_key is not None:
+            domain.append(('index_key', '=', index_key))
+        return cls.search(domain)
+
+    @classmethod
+    def filter_changed(cls, index_key, model_name, digests):
+        """
+        Return the list of the ids whose digest differs from the digest of
+        the document last indexed into the index.
+
+        :param index_key: Key of the index, see `BulkIndexer.index_key`
+        :param model_name: Name of the model of the records
+        :param digests: Dictionary mapping record ids to their digest
+        """
+        indexed = dict(
+            (h.record_id, h.digest)
+            for h in cls._search_records(
+                model_name, digests.keys(), index_key
+            )
+        )
+        return [
+            record_id for record_id, digest in digests.iteritems()
+            if indexed.get(record_id) != digest
+        ]
+
+    @classmethod
+    def remember(cls, index_key, model_name, digests):
+        """
+        Store the digests of the documents which were just indexed into the
+        index.
+
+        :param index_key: Key of the index, see `BulkIndexer.index_key`
+        :param model_name: Name of the model of the records
+        :param digests: Dictionary mapping record ids to their digest
+        """
+        if not digests:
+            return
+        cls.delete(cls._search_records(model_name, digests.keys(), index_key))
+        cls.create([{
+            'index_key': index_key,
+            'record_model': model_name,
+            'record_id': record_id,
+            'digest': digest,
+        } for record_id, digest in digests.iteritems()])
+
+    @classmethod
+    def forget(cls, model_name, record_ids=None):
+        """
+        Delete the digests of the given records (all the records of the
+        model if None) for every index, whose documents will then be sent
+        again.
+        """
+        if record_ids is not None and not record_ids:
+            return
+        cls.delete(cls._search_records(model_name, record_ids))
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+    cache.py
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+from threading import Lock
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A thread safe mapping of at most `size` items, which discards the least
+    recently used item when it is full, and the items older than `ttl`
+    seconds if a `ttl` is given.
+
+    Unlike `trytond.cache.Cache`, it is shared by all the databases of the
+    process, for values which do not depend on the database.
+
+    >>> cache = LRUCache(size=2)
+    >>> cache.set('a', 1)
+    >>> cache.get('a')
+    1
+    >>> cache.get('b') is None
+    True
+    """
+
+    def __init__(self, size=1024, ttl=None):
+        """
+        :param size: Maximum number of items
+        :param ttl: Number of seconds the items are kept, forever if `None`
+        """
+        self.size = size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """
+        Return the value of the key, or `default` if it is not cached.
+        """
+        with self._lock:
+            try:
+                expires, value = self._items.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                return default
+            self._items[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        """
+        Cache the value of the key, discarding the least recently used item
+        if the cache is full.
+        """
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (expires, value)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        """
+        Discard all the items.
+        """
+        with self._lock:
+            self._items.clear()
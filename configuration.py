@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+    configuration.py
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import json
+from datetime import datetime
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.model import fields
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+from indexer import refresh_and_wait
+
+__metaclass__ = PoolMeta
+__all__ = ['Configuration']
+
+
+class Configuration:
+    __name__ = 'elasticsearch.configuration'
+
+    sync_watermark = fields.DateTime(
+        'Synchronisation Watermark', readonly=True,
+        help="Records created or written after this time are added to the "
+        "backlog by the next synchronisation"
+    )
+    index_version = fields.Integer(
+        'Index Version', readonly=True,
+        help="Incremented whenever documents are sent to the index, so that "
+        "the cached search results are not used anymore (on PostgreSQL the "
+        "version is kept in a sequence instead)"
+    )
+
+    _index_version_cache = Cache(
+        'elasticsearch.configuration.index_version', context=False
+    )
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(Configuration, cls).__register__(module_name)
+
+        sequence_name = cls._get_index_version_sequence()
+        if sequence_name and not TableHandler.sequence_exist(
+                cursor, sequence_name):
+            cursor.execute('CREATE SEQUENCE "%s"' % sequence_name)
+
+    @staticmethod
+    def default_index_version():
+        return 0
+
+    @classmethod
+    def _get_index_version_sequence(cls):
+        """
+        Returns the name of the sequence holding the version of the index on
+        PostgreSQL, None on the other backends.
+
+        Like the index, a sequence is not transactional: the version is
+        incremented as soon as documents are sent, even if the transaction
+        sending them is rolled back, and concurrent transactions increment
+        it without conflicting on the configuration record.
+        """
+        if backend.name() == 'postgresql':
+            return '%s_index_version_seq' % cls._table
+
+    @classmethod
+    def get_index_version(cls):
+        """
+        Returns the current version of the index, from a cache of the
+        database which is cleared when the version is incremented.
+        """
+        version = cls._index_version_cache.get(None)
+        if version is None:
+            sequence_name = cls._get_index_version_sequence()
+            if sequence_name:
+                cursor = Transaction().cursor
+                cursor.execute(
+                    'SELECT CASE WHEN is_called THEN last_value ELSE 0 END '
+                    'FROM "%s"' % sequence_name
+                )
+                version, = cursor.fetchone()
+            else:
+                version = cls(1).index_version or 0
+            cls._index_version_cache.set(None, version)
+        return version
+
+    @classmethod
+    def increment_index_version(cls):
+        """
+        Increment the version of the index, atomically so that concurrent
+        backlog drainers each get their own version.
+        """
+        cursor = Transaction().cursor
+        sequence_name = cls._get_index_version_sequence()
+
+        if sequence_name:
+            cursor.execute('SELECT NEXTVAL(\'"%s"\')' % sequence_name)
+        else:
+            cursor.execute('SELECT id FROM "%s"' % cls._table)
+            if cursor.fetchone():
+                cursor.execute(
+                    'UPDATE "%s" SET index_version = '
+                    'COALESCE(index_version, 0) + 1' % cls._table
+                )
+            else:
+                cls.write([cls(1)], {'index_version': 1})
+        cls._index_version_cache.clear()
+
+    def get_index_generations(self):
+        """
+        Returns the sorted list of the generations of the index, the oldest
+        first.
+
+        A generation is an index named after the index of the configuration
+        followed by the time it was created. The name of the index of the
+        configuration itself is an alias to the current generation.
+        """
+        conn = self.get_es_connection()
+        prefix = self.get_index_name(name=None) + '_'
+
+        return sorted(
+            name for name in conn.indices.get_indices(include_aliases=False)
+            if name.startswith(prefix) and name[len(prefix):].isdigit()
+        )
+
+    def create_index_generation(self):
+        """
+        Create a new and empty generation of the index, with the settings of
+        the configuration and the mapping of every document type (like
+        `es_product_document` for products), and return its name.
+
+        Nothing reads from the new generation until `swap_index_alias` is
+        called, so it can be filled while the current one is still searched.
+        """
+        DocumentType = Pool().get('elasticsearch.document.type')
+
+        conn = self.get_es_connection()
+        index_name = '%s_%s' % (
+            self.get_index_name(name=None),
+            datetime.utcnow().strftime('%Y%m%d%H%M%S%f'),
+        )
+
+        conn.indices.create_index(
+            index_name, json.loads(self.settings) if self.settings else None
+        )
+        for document_type in DocumentType.search([]):
+            conn.indices.put_mapping(
+                self.make_type_name(document_type.model.model),
+                json.loads(document_type.mapping),
+                [index_name]
+            )
+        return index_name
+
+    def swap_index_alias(self, index_name, keep=1):
+        """
+        Atomically point the alias of the index to the given generation, and
+        delete the other generations but the `keep` most recent ones which
+        are not newer than the generation the alias pointed to: the rollback
+        targets. Newer generations were left by rebuilds which were not
+        swapped, and are deleted.
+
+        If the index of the configuration is still an index rather than an
+        alias (as created by earlier versions), it has to be deleted before
+        the alias can be created, which leaves the shop without search
+        results for a moment.
+
+        :param index_name: Name of the generation to make current
+        :param keep: Number of previous generations to keep, for rollbacks
+        """
+        logger = self.get_logger()
+        conn = self.get_es_connection()
+        alias = self.get_index_name(name=None)
+
+        existing = conn.indices.get_indices(include_aliases=True).get(alias)
+        if existing is not None and 'alias_for' not in existing:
+            logger.warning("Replacing index %s by an alias" % alias)
+            conn.indices.delete_index(alias)
+            existing = None
+        current = existing['alias_for'] if existing else []
+
+        conn.indices.change_aliases(
+            [('remove', name, alias, {}) for name in current] +
+            [('add', index_name, alias, {})]
+        )
+        self.increment_index_version()
+
+        previous = [
+            name for name in self.get_index_generations()
+            if name != index_name
+        ]
+        rollback = sorted(
+            (name for name in previous if current and name <= max(current)),
+            reverse=True
+        )[:keep]
+        for name in previous:
+            if name not in rollback:
+                logger.info("Deleting index generation %s" % name)
+                conn.indices.delete_index(name)
+
+    def refresh_and_wait(self, index_name=None, timeout=30):
+        """
+        Make every document indexed so far searchable, and return once the
+        index is ready to be searched.
+
+        >>> IndexBacklog.update_index()
+        >>> Configuration(1).refresh_and_wait()
+
+        :param index_name: Name of the index, the index of the configuration
+                           if not given
+        :param timeout: Maximum number of seconds to wait for the index
+        """
+        refresh_and_wait(
+            self.get_es_connection(),
+            index_name or self.get_index_name(name=None),
+            timeout
+        )
@@ -0,0 +1,657 @@
+# -*- coding: utf-8 -*-
+"""
+    es_commands.py
+
+    Command line maintenance of the elasticsearch index of the webshop::
+
+        python -m trytond.modules.nereid_webshop_elastic_search.es_commands \\
+            -c trytond.conf -d database rebuild --processes 16
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import json
+import time
+import logging
+import argparse
+import multiprocessing
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import count
+
+from pyes import ES
+from pyes.es import ESJsonEncoder
+
+from trytond.cache import Cache
+from trytond.config import CONFIG
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from trytond.modules.nereid_webshop_elastic_search.indexer import \
+    BulkIndexer, Throttle, chunks, scan_ids, start_bulk_load, end_bulk_load, \
+    refresh_and_wait
+from trytond.modules.nereid_webshop_elastic_search.backlog import \
+    CHANGES_MARGIN
+
+logger = logging.getLogger('nereid_webshop_elastic_search')
+
+
+@contextmanager
+def transaction(database_name, login='admin'):
+    """
+    Start a transaction on the database as the user with the given login and
+    with the user's preferences in the context. The transaction is committed
+    if the block succeeds.
+    """
+    pool = Pool(database_name)
+    if database_name not in Pool.database_list():
+        pool.init()
+
+    User = pool.get('res.user')
+
+    with Transaction().start(database_name, 0) as txn:
+        user, = User.search([('login', '=', login)])
+        with Transaction().set_user(user.id), \
+                Transaction().set_context(
+                    User.get_preferences(context_only=True)):
+            yield pool
+        txn.cursor.commit()
+    # Let the other processes clear the caches cleared by the transaction
+    Cache.resets(database_name)
+
+
+def partition(ids, workers):
+    """
+    Split the sorted ids into at most `workers` contiguous ranges of
+    (almost) equal size, and return them as a list of (lo, hi) tuples of the
+    ids with `lo <= id < hi`.
+
+    The first range has no lower bound and the last one no upper bound (a
+    `None` bound), so that the ranges cover every id, even the ids of the
+    records created after the split.
+
+    >>> partition(range(1, 101), 2)
+    [(None, 51), (51, None)]
+    """
+    size = max(-(-len(ids) // workers), 1)
+    bounds = [None] + list(ids[size::size]) + [None]
+    return zip(bounds[:-1], bounds[1:])
+
+
+def get_range_domain(lo, hi):
+    """
+    Return the domain of the ids of a range returned by `partition`.
+    """
+    domain = []
+    if lo is not None:
+        domain.append(('id', '>=', lo))
+    if hi is not None:
+        domain.append(('id', '<', hi))
+    return domain
+
+
+def _get_id_ranges(database_name, login, workers):
+    with transaction(database_name, login) as pool:
+        Product = pool.get('product.product')
+
+        return partition(
+            [p.id for p in Product.search([], order=[('id', 'ASC')])],
+            workers
+        )
+
+
+def _reindex_worker(args):
+    """
+    Serialize and bulk index the products of one range of ids, in a
+    transaction of its own. Returns the number of documents indexed and the
+    errors.
+    """
+    database_name, login, worker, (lo, hi), chunk_size, index_name = args
+
+    with transaction(database_name, login) as pool:
+        DocumentHash = pool.get('elasticsearch.document_hash')
+        Product = pool.get('product.product')
+
+        product_ids = [
+            p.id for p in Product.search(
+                get_range_domain(lo, hi), order=[('id', 'ASC')]
+            )
+        ]
+        # The documents indexed are not recorded, so make the backlog send
+        # them again rather than trust digests of older documents
+        DocumentHash.forget(Product.__name__, product_ids)
+        indexer = Product.elastic_search_bulk_index(
+            Product.browse(product_ids),
+            indexer=BulkIndexer.from_config(
+                Product.__name__, index_name=index_name,
+                chunk_size=chunk_size
+            ),
+            chunk_size=chunk_size,
+        )
+
+    return {
+        'worker': worker,
+        'products': len(product_ids),
+        'indexed': indexer.succeeded,
+        'errors': indexer.errors,
+    }
+
+
+def reindex(
+    database_name, login='admin', processes=None, chunk_size=500,
+    index_name=None
+):
+    """
+    Reindex all the products, split in ranges of ids which are serialized
+    and bulk indexed by `processes` worker processes.
+
+    The bounds of the ranges are computed once, before the workers start,
+    so that the products created or deleted meanwhile do not shift the
+    ranges of the other workers.
+
+    The parent process does not touch the database, so that the worker
+    processes do not share its connections.
+
+    Returns the merged results of the workers: the number of products, of
+    indexed documents and the list of errors. The version of the index is
+    incremented once the workers are done, so that the cached search
+    results are not used anymore.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    id_ranges = _run_in_process(
+        _get_id_ranges, database_name, login, processes
+    )
+    tasks = [
+        (database_name, login, worker, id_range, chunk_size, index_name)
+        for worker, id_range in enumerate(id_ranges)
+    ]
+
+    total = {'products': 0, 'indexed': 0, 'errors': []}
+
+    workers = multiprocessing.Pool(processes)
+    try:
+        for result in workers.imap_unordered(_reindex_worker, tasks):
+            logger.info(
+                "Worker %d indexed %d of %d products" % (
+                    result['worker'], result['indexed'], result['products']
+                )
+            )
+            total['products'] += result['products']
+            total['indexed'] += result['indexed']
+            total['errors'].extend(result['errors'])
+    finally:
+        workers.close()
+        workers.join()
+
+    # The cached search results may be out of date
+    _run_in_process(_increment_index_version, database_name, login)
+    return total
+
+
+def _increment_index_version(database_name, login):
+    with transaction(database_name, login) as pool:
+        pool.get('elasticsearch.configuration').increment_index_version()
+
+
+def _run_in_process(func, *args):
+    """
+    Run the function in a child process and return its result, so that the
+    calling process does not open database connections which the worker
+    processes forked later would inherit.
+    """
+    workers = multiprocessing.Pool(1)
+    try:
+        return workers.apply(func, args)
+    finally:
+        workers.close()
+        workers.join()
+
+
+def _create_index_generation(database_name, login):
+    with transaction(database_name, login) as pool:
+        Configuration = pool.get('elasticsearch.configuration')
+
+        config = Configuration(1)
+        index_name = config.create_index_generation()
+
+        # Nothing searches the new generation until the swap
+        settings = start_bulk_load(config.get_es_connection(), index_name)
+        return index_name, settings
+
+
+def _delete_stale_documents(pool, index_name):
+    """
+    Delete from the given index the documents of the products which were
+    deleted or deactivated since they were indexed, and return their ids.
+
+    The backlog removes such products from the index behind the alias, not
+    from a generation being rebuilt, and they are not returned by
+    `search_elastic_search_changed` once deleted.
+    """
+    Product = pool.get('product.product')
+
+    indexer = BulkIndexer.from_config(Product.__name__, index_name=index_name)
+    indexed_ids = list(scan_ids(indexer.conn, index_name, indexer.doc_type))
+
+    existing_ids = set()
+    for sub_ids in chunks(indexed_ids, Transaction().cursor.IN_MAX):
+        existing_ids.update(
+            p.id for p in Product.search([('id', 'in', sub_ids)])
+        )
+
+    stale_ids = [i for i in indexed_ids if i not in existing_ids]
+    for product_id in stale_ids:
+        indexer.delete(product_id)
+    indexer.flush()
+
+    for error in indexer.errors:
+        logger.error(
+            "Could not delete product %s from %s: %s" % (
+                error['id'], index_name, error['error']
+            )
+        )
+    refresh_and_wait(indexer.conn, index_name)
+    return stale_ids
+
+
+def _delete_index_generation(database_name, login, index_name):
+    with transaction(database_name, login) as pool:
+        Configuration = pool.get('elasticsearch.configuration')
+
+        logger.info("Deleting index generation %s" % index_name)
+        Configuration(1).get_es_connection().indices.delete_index(index_name)
+
+
+def _swap_index_alias(
+    database_name, login, index_name, settings, keep, since
+):
+    with transaction(database_name, login) as pool:
+        Configuration = pool.get('elasticsearch.configuration')
+        DocumentHash = pool.get('elasticsearch.document_hash')
+        IndexBacklog = pool.get('elasticsearch.index_backlog')
+        Product = pool.get('product.product')
+
+        config = Configuration(1)
+        end_bulk_load(config.get_es_connection(), index_name, settings)
+        stale_ids = _delete_stale_documents(pool, index_name)
+        if stale_ids:
+            logger.info(
+                "Deleted %d products removed during the rebuild from %s" % (
+                    len(stale_ids), index_name
+                )
+            )
+        config.swap_index_alias(index_name, keep)
+
+        # The digests of the previous generations are not used anymore
+        DocumentHash.forget(Product.__name__)
+
+        # Changes indexed in the previous generation during the rebuild
+        IndexBacklog.create_from_records(
+            Product.search_elastic_search_changed(since)
+        )
+
+
+def rebuild(
+    database_name, login='admin', processes=None, chunk_size=500, keep=1,
+    force=False
+):
+    """
+    Rebuild the index without downtime: the products are reindexed in
+    parallel into a new generation of the index, then the alias searched by
+    the webshop is swapped to it and the old generations are deleted.
+
+    The new generation is not refreshed nor replicated while it is filled
+    (see `BULK_LOAD_SETTINGS`), its settings are restored and it is
+    refreshed before the swap.
+
+    The backlog keeps updating the current generation during the rebuild,
+    so the products changed since the rebuild started are added to the
+    backlog again once the alias points to the new generation, and the
+    products deleted or deactivated meanwhile are deleted from the new
+    generation before the swap.
+
+    Returns the merged results of `reindex`, with the name of the new
+    generation in `index` and whether the alias was swapped in `swapped`.
+    The new generation is deleted if the alias is not swapped to it.
+
+    :param keep: Number of previous generations to keep
+    :param force: Swap the alias even if some products failed to index
+    """
+    since = datetime.now() - CHANGES_MARGIN
+
+    index_name, settings = _run_in_process(
+        _create_index_generation, database_name, login
+    )
+    swapped = False
+    try:
+        result = reindex(
+            database_name, login, processes, chunk_size, index_name
+        )
+        result['index'] = index_name
+        result['swapped'] = force or not result['errors']
+
+        if result['swapped']:
+            _run_in_process(
+                _swap_index_alias, database_name, login, index_name,
+                settings, keep, since
+            )
+            swapped = True
+    finally:
+        if not swapped:
+            _run_in_process(
+                _delete_index_generation, database_name, login, index_name
+            )
+    return result
+
+
+def export(database_name, output, login='admin', chunk_size=500):
+    """
+    Write the documents of all the products to the given file, one JSON
+    document per line (NDJSON), and return the number of documents.
+
+    The documents are streamed from `elastic_search_documents`, so the
+    memory used does not grow with the size of the catalog.
+    """
+    with transaction(database_name, login):
+        return export_documents(output, chunk_size)
+
+
+def export_documents(output, chunk_size=500):
+    """
+    Write the documents of all the products to the given file like
+    `export`, in the current transaction.
+    """
+    Product = Pool().get('product.product')
+
+    count = 0
+    for document in Product.elastic_search_documents(chunk_size):
+        output.write(json.dumps(document, cls=ESJsonEncoder) + '\n')
+        count += 1
+    return count
+
+
+def load(
+    conn, source, index_name, doc_type, chunk_size=500, bulk_settings=False
+):
+    """
+    Bulk index the documents of an NDJSON file written by `export` into the
+    given index, without any access to the database. The index is refreshed
+    once all the documents are sent. The search results cached by the
+    webshop are used until they expire, unless the version of the index is
+    incremented (as the load command does when given a database).
+
+    Returns the `BulkIndexer` used, with the number of documents indexed
+    and the errors.
+
+    :param conn: The `~pyes.es.ES` connection to the target cluster
+    :param source: File to read the documents from
+    :param index_name: Name of the index (or alias) to load into
+    :param doc_type: Name of the document type of the documents
+    :param bulk_settings: Disable the refresh and the replicas of the index
+                          during the load, for an index which is not
+                          searched yet
+    """
+    indexer = BulkIndexer(conn, index_name, doc_type, chunk_size=chunk_size)
+    if bulk_settings:
+        settings = start_bulk_load(conn, index_name)
+
+    try:
+        for line in source:
+            if not line.strip():
+                continue
+            document = json.loads(line)
+            indexer.index(document['id'], document)
+        indexer.flush()
+    finally:
+        if bulk_settings:
+            end_bulk_load(conn, index_name, settings)
+        else:
+            refresh_and_wait(conn, index_name)
+
+    return indexer
+
+
+def work(
+    database_name, login='admin', throttle=None, idle_delay=5, batches=None
+):
+    """
+    Drain the index backlog forever, one batch per transaction, with the
+    batch size and the rate controlled by the given `Throttle`.
+
+    :param idle_delay: Seconds to wait when the backlog is empty
+    :param batches: Number of batches to process before returning, forever
+                    if None
+    """
+    throttle = throttle or Throttle()
+
+    for _ in (count() if batches is None else xrange(batches)):
+        start = time.time()
+        try:
+            with transaction(database_name, login) as pool:
+                IndexBacklog = pool.get('elasticsearch.index_backlog')
+
+                stats = IndexBacklog.update_index(throttle.batch_size)
+        except Exception:
+            logger.exception("Could not process the index backlog")
+            throttle.pushed_back()
+            continue
+
+        throttle.update(stats, time.time() - start)
+        if stats['entries']:
+            logger.info(
+                "Processed %d backlog entries, %d documents, %d rejected, "
+                "next batch size %d" % (
+                    stats['entries'], stats['documents'], stats['rejected'],
+                    throttle.batch_size,
+                )
+            )
+        else:
+            time.sleep(idle_delay)
+
+
+def _log_reindex_result(result):
+    for error in result['errors']:
+        logger.error(
+            "Could not index product %s: %s" % (error['id'], error['error'])
+        )
+    logger.info(
+        "Indexed %d of %d products, %d errors" % (
+            result['indexed'], result['products'], len(result['errors'])
+        )
+    )
+
+
+def _reindex_command(options):
+    result = reindex(
+        options.database, options.user, options.processes,
+        options.chunk_size
+    )
+    _log_reindex_result(result)
+    return 1 if result['errors'] else 0
+
+
+def _rebuild_command(options):
+    result = rebuild(
+        options.database, options.user, options.processes,
+        options.chunk_size, options.keep, options.force
+    )
+    _log_reindex_result(result)
+    if not result['swapped']:
+        logger.error(
+            "The alias was not swapped to %s because of errors, it was "
+            "deleted" % result['index']
+        )
+        return 1
+    logger.info("The alias now points to %s" % result['index'])
+    return 0
+
+
+def _work_command(options):
+    work(
+        options.database, options.user, Throttle(
+            max_rate=options.max_rate,
+            max_batch_size=options.max_batch_size,
+            target_latency=options.target_latency,
+        ), batches=options.batches
+    )
+
+
+def _export_command(options):
+    if options.output == '-':
+        count = export(options.database, sys.stdout, options.user)
+    else:
+        with open(options.output, 'w') as output:
+            count = export(options.database, output, options.user)
+    logger.info("Exported %d products" % count)
+    return 0
+
+
+def _load_command(options):
+    conn = ES(options.server.split(','))
+
+    if options.input == '-':
+        indexer = load(
+            conn, sys.stdin, options.index, options.doc_type,
+            bulk_settings=options.bulk_settings
+        )
+    else:
+        with open(options.input) as source:
+            indexer = load(
+                conn, source, options.index, options.doc_type,
+                bulk_settings=options.bulk_settings
+            )
+
+    if options.database:
+        _increment_index_version(options.database, options.user)
+
+    for error in indexer.errors:
+        logger.error(
+            "Could not load document %s: %s" % (error['id'], error['error'])
+        )
+    logger.info(
+        "Loaded %d documents, %d errors" % (
+            indexer.succeeded, len(indexer.errors)
+        )
+    )
+    return 1 if indexer.errors else 0
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Maintain the elasticsearch index of the webshop"
+    )
+    parser.add_argument('-c', '--config', dest='config', default=None)
+    parser.add_argument(
+        '-d', '--database', dest='database',
+        help="Database of the products, optional for the load command "
+        "which then leaves the cached search results until they expire"
+    )
+    parser.add_argument('-u', '--user', dest='user', default='admin')
+    subparsers = parser.add_subparsers()
+
+    reindex_parser = subparsers.add_parser(
+        'reindex', help="Reindex all the products in parallel"
+    )
+    reindex_parser.add_argument(
+        '-p', '--processes', dest='processes', type=int, default=None
+    )
+    reindex_parser.add_argument(
+        '--chunk-size', dest='chunk_size', type=int, default=500
+    )
+    reindex_parser.set_defaults(func=_reindex_command)
+
+    rebuild_parser = subparsers.add_parser(
+        'rebuild',
+        help="Rebuild the products in a new index generation and swap the "
+        "alias to it"
+    )
+    rebuild_parser.add_argument(
+        '-p', '--processes', dest='processes', type=int, default=None
+    )
+    rebuild_parser.add_argument(
+        '--chunk-size', dest='chunk_size', type=int, default=500
+    )
+    rebuild_parser.add_argument(
+        '--keep', dest='keep', type=int, default=1,
+        help="Number of previous generations to keep"
+    )
+    rebuild_parser.add_argument(
+        '--force', dest='force', action='store_true',
+        help="Swap the alias even if some products could not be indexed"
+    )
+    rebuild_parser.set_defaults(func=_rebuild_command)
+
+    work_parser = subparsers.add_parser(
+        'work', help="Process the index backlog continuously"
+    )
+    work_parser.add_argument(
+        '--max-rate', dest='max_rate', type=float, default=500,
+        help="Maximum number of documents sent per second"
+    )
+    work_parser.add_argument(
+        '--max-batch-size', dest='max_batch_size', type=int, default=1000,
+        help="Maximum number of backlog entries per batch"
+    )
+    work_parser.add_argument(
+        '--target-latency', dest='target_latency', type=float, default=1.0,
+        help="Average bulk request duration above which the batches shrink"
+    )
+    work_parser.add_argument(
+        '--batches', dest='batches', type=int, default=None,
+        help="Number of batches to process before exiting, forever by "
+        "default"
+    )
+    work_parser.set_defaults(func=_work_command)
+
+    export_parser = subparsers.add_parser(
+        'export', help="Export the product documents as NDJSON"
+    )
+    export_parser.add_argument(
+        '-o', '--output', dest='output', default='-',
+        help="File to write to, - for the standard output"
+    )
+    export_parser.set_defaults(func=_export_command)
+
+    load_parser = subparsers.add_parser(
+        'load', help="Load an NDJSON export into an index"
+    )
+    load_parser.add_argument(
+        '-i', '--input', dest='input', default='-',
+        help="File to read from, - for the standard input"
+    )
+    load_parser.add_argument(
+        '--server', dest='server', default='http://localhost:9200',
+        help="Comma separated elasticsearch servers to load into"
+    )
+    load_parser.add_argument('--index', dest='index', required=True)
+    load_parser.add_argument(
+        '--doc-type', dest='doc_type', default='product_product'
+    )
+    load_parser.add_argument(
+        '--bulk-settings', dest='bulk_settings', action='store_true',
+        help="Disable the refresh and the replicas of the index during the "
+        "load, for an index which is not searched yet"
+    )
+    load_parser.set_defaults(func=_load_command)
+
+    return parser
+
+
+def main(args=None):
+    parser = get_parser()
+    options = parser.parse_args(args)
+    if options.func is not _load_command and not options.database:
+        parser.error("a database is required")
+
+    logging.basicConfig(level=logging.INFO)
+    if options.config:
+        CONFIG.update_etc(options.config)
+    CONFIG.set_timezone()
+    Pool.start()
+
+    return options.func(options)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+    indexer.py
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import json
+import time
+import hashlib
+from itertools import islice
+
+from pyes.exceptions import IndexMissingException
+from trytond.pool import Pool
+
+
+#: Index settings used while an index is bulk loaded: the segments are not
+#: refreshed and the documents are not copied to replicas until the load is
+#: over, which makes it much faster.
+BULK_LOAD_SETTINGS = {
+    'refresh_interval': '-1',
+    'number_of_replicas': 0,
+}
+
+#: Value of the settings which are not set explicitly on an index
+DEFAULT_SETTINGS = {
+    'refresh_interval': '1s',
+    'number_of_replicas': 1,
+}
+
+
+def chunks(iterable, size):
+    """
+    Yield lists of at most `size` items from the given iterable.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def get_index_settings(conn, index_name, names):
+    """
+    Return a dictionary of the value of the given settings of the index (or
+    of the index an alias points to), without their `index.` prefix.
+    """
+    response = conn.indices.get_settings(index_name)
+    settings = response.values()[0]['settings']
+
+    result = {}
+    for name in names:
+        if 'index' in settings:
+            value = settings['index'].get(name)
+        else:
+            value = settings.get('index.' + name)
+        result[name] = value if value is not None else DEFAULT_SETTINGS[name]
+    return result
+
+
+def get_index_key(conn, index_name):
+    """
+    Return a string identifying the index itself (or the index an alias
+    points to): its name and its uuid, so that an index deleted and created
+    again under the same name has another key. Returns `None` if the index
+    does not exist.
+    """
+    try:
+        response = conn.indices.get_settings(index_name)
+    except IndexMissingException:
+        return None
+    name, data = sorted(response.items())[0]
+    settings = data['settings']
+    if 'index' in settings:
+        uuid = settings['index'].get('uuid')
+    else:
+        uuid = settings.get('index.uuid')
+    return '%s/%s' % (name, uuid) if uuid else name
+
+
+def start_bulk_load(conn, index_name):
+    """
+    Apply the `BULK_LOAD_SETTINGS` to the index and return its previous
+    settings, to be given to `end_bulk_load`.
+    """
+    previous = get_index_settings(conn, index_name, BULK_LOAD_SETTINGS)
+    conn.indices.update_settings(index_name, {'index': BULK_LOAD_SETTINGS})
+    return previous
+
+
+def end_bulk_load(conn, index_name, previous, timeout=30):
+    """
+    Restore the settings returned by `start_bulk_load` and wait until the
+    documents loaded are searchable.
+    """
+    conn.indices.update_settings(index_name, {'index': previous})
+    refresh_and_wait(conn, index_name, timeout)
+
+
+def refresh_and_wait(conn, index_name, timeout=30):
+    """
+    Refresh the index, so that every document indexed so far is returned by
+    searches, and wait (at most `timeout` seconds) until all its primary
+    shards are allocated.
+
+    Use this rather than sleeping after an indexing when the next step (a
+    test, a deploy script) expects to find the documents.
+    """
+    conn.indices.refresh([index_name])
+    conn.cluster.health(
+        indices=[index_name], wait_for_status='yellow', timeout=timeout
+    )
+
+
+def scan_ids(conn, index_name, doc_type, size=1000):
+    """
+    Yield the ids of all the documents of the given type in the index, read
+    with a scroll without their source.
+    """
+    response = conn._send_request(
+        'GET', '/%s/%s/_search' % (index_name, doc_type),
+        {'_source': False, 'query': {'match_all': {}}},
+        params={'scroll': '1m', 'size': size}
+    )
+    while response['hits']['hits']:
+        for hit in response['hits']['hits']:
+            yield int(hit['_id'])
+        response = conn._send_request(
+            'GET', '/_search/scroll', response['_scroll_id'],
+            params={'scroll': '1m'}
+        )
+
+
+class BulkIndexer(object):
+    """
+    Streams indexing actions on one document type into elasticsearch
+    `_bulk` requests.
+
+    A request is sent whenever `chunk_size` actions or `max_bytes` bytes are
+    buffered, and when `flush` is called. Items rejected with a transient
+    error (see `retry_statuses`) are retried up to `max_retries` times with
+    an exponential backoff. Every other failed item, and the transient
+    failures which persisted, are reported in `errors`.
+
+    >>> indexer = BulkIndexer.from_config('product.product')
+    >>> for document in documents:
+    ...     indexer.index(document['id'], document)
+    >>> indexer.flush()
+    >>> indexer.errors
+    []
+    """
+    #: Item statuses for which the item is sent again
+    retry_statuses = (429, 503)
+
+    def __init__(
+        self, conn, index_name, doc_type, chunk_size=500,
+        max_bytes=5 * 1024 * 1024, max_retries=3, retry_delay=1
+    ):
+        """
+        :param conn: The `~pyes.es.ES` connection
+        :param index_name: Name of the index (or alias) to write to
+        :param doc_type: Name of the document type
+        :param chunk_size: Maximum number of actions per request
+        :param max_bytes: Maximum size of the body of a request
+        :param max_retries: Number of times transient failures are retried
+        :param retry_delay: Seconds to wait before the first retry
+        """
+        self.conn = conn
+        self.index_name = index_name
+        self.doc_type = doc_type
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        self.actions = []
+        self.actions_size = 0
+
+        #: Number of actions which succeeded
+        self.succeeded = 0
+        #: Number of items rejected with a transient error, retried or not
+        self.rejected = 0
+        #: Number of `_bulk` requests sent and seconds spent waiting for them
+        self.requests = 0
+        self.request_time = 0.0
+        #: List of dictionaries describing the actions which failed
+        self.errors = []
+
+    @classmethod
+    def from_config(cls, model_name, index_name=None, **kwargs):
+        """
+        Return an indexer for the documents of the given model, using the
+        connection and the index of the elasticsearch configuration.
+        """
+        config = Pool().get('elasticsearch.configuration')(1)
+
+        return cls(
+            config.get_es_connection(),
+            index_name or config.get_index_name(name=None),
+            config.make_type_name(model_name),
+            **kwargs
+        )
+
+    @property
+    def index_key(self):
+        """
+        The key of the index the documents are sent to (see
+        `get_index_key`), looked up once.
+        """
+        if not hasattr(self, '_index_key'):
+            self._index_key = get_index_key(self.conn, self.index_name)
+        return self._index_key
+
+    @property
+    def failed_ids(self):
+        """
+        Returns the set of ids of the documents whose action failed.
+        """
+        return set(error['id'] for error in self.errors)
+
+    def index(self, record_id, document):
+        """
+        Add (or replace) the document of the given id.
+        """
+        self._add('index', record_id, document)
+
+    def update(self, record_id, fragment):
+        """
+        Update the given fields of the document of the given id, leaving its
+        other fields unchanged.
+        """
+        self._add('update', record_id, {'doc': fragment})
+
+    def delete(self, record_id):
+        """
+        Remove the document of the given id.
+        """
+        self._add('delete', record_id)
+
+    def digest(self, document):
+        """
+        Return a digest of the document, which is stable across runs.
+        """
+        return hashlib.sha1(
+            json.dumps(document, sort_keys=True, cls=self.conn.encoder)
+        ).hexdigest()
+
+    def _encode(self, data):
+        return json.dumps(data, cls=self.conn.encoder)
+
+    def _add(self, action, record_id, source=None):
+        lines = [self._encode({
+            action: {
+                '_index': self.index_name,
+                '_type': self.doc_type,
+                '_id': record_id,
+            }
+        })]
+        if source is not None:
+            lines.append(self._encode(source))
+        payload = '\n'.join(lines) + '\n'
+
+        self.actions.append((action, record_id, payload))
+        self.actions_size += len(payload)
+
+        if len(self.actions) >= self.chunk_size or \
+                self.actions_size >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        """
+        Send the buffered actions, retrying the transient failures.
+        """
+        actions, self.actions, self.actions_size = self.actions, [], 0
+        if not actions:
+            return
+
+        for attempt in xrange(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            retries = self._send(actions)
+            if not retries:
+                return
+            actions = [action for action, _ in retries]
+
+        self.errors.extend(
+            self._error(action, result) for action, result in retries
+        )
+
+    def _send(self, actions):
+        """
+        Send the given actions in one `_bulk` request and return the list of
+        (action, result) tuples which should be retried.
+        """
+        start = time.time()
+        response = self.conn._send_request(
+            'POST', '/_bulk', ''.join(payload for _, _, payload in actions)
+        )
+        self.requests += 1
+        self.request_time += time.time() - start
+
+        retries = []
+        for action, item in zip(actions, response['items']):
+            result = item.values()[0]
+            status = result.get('status', 500 if 'error' in result else 200)
+            if status < 300 or (action[0] != 'index' and status == 404):
+                # The document is not in the index (yet), which is fine for
+                # a deletion. An update has nothing to do either, the
+                # document will be indexed from scratch.
+                self.succeeded += 1
+            elif status in self.retry_statuses:
+                self.rejected += 1
+                retries.append((action, result))
+            else:
+                self.errors.append(self._error(action, result))
+        return retries
+
+    @staticmethod
+    def _error(action, result):
+        return {
+            'action': action[0],
+            'id': action[1],
+            'status': result.get('status'),
+            'error': result.get('error'),
+        }
+
+
+class Throttle(object):
+    """
+    Paces a consumer of the index backlog so that it does not compete with
+    the search traffic of the cluster.
+
+    The batch size grows additively while the bulk requests are accepted
+    and fast, and is halved (with a pause) as soon as items are rejected or
+    the requests take longer than `target_latency` on average.
+    Independently, the rate never exceeds `max_rate` documents per second.
+    """
+
+    def __init__(
+        self, max_rate=500, min_batch_size=10, max_batch_size=1000,
+        target_latency=1.0, backoff=5
+    ):
+        """
+        :param max_rate: Maximum number of documents sent per second
+        :param min_batch_size: Smallest number of entries per batch
+        :param max_batch_size: Largest number of entries per batch
+        :param target_latency: Average duration of the bulk requests, in
+                               seconds, above which the cluster is
+                               considered loaded
+        :param backoff: Seconds to pause when the cluster pushes back
+        """
+        self.max_rate = max_rate
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.target_latency = target_latency
+        self.backoff = backoff
+
+        self.batch_size = min_batch_size
+
+    def pushed_back(self):
+        """
+        Halve the batch size and pause, because the cluster rejected work.
+        """
+        self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+        time.sleep(self.backoff)
+
+    def update(self, stats, elapsed):
+        """
+        Adapt to the statistics of a batch (as returned by
+        `update_index`) which took `elapsed` seconds, and wait as long as
+        needed to respect the maximum rate.
+        """
+        latency = stats['request_time'] / max(stats['requests'], 1)
+
+        if stats['rejected'] or latency > self.target_latency:
+            self.pushed_back()
+        elif stats['entries'] >= self.batch_size:
+            self.batch_size = min(
+                self.max_batch_size, self.batch_size + self.min_batch_size
+            )
+
+        delay = stats['documents'] / float(self.max_rate) - elapsed
+        if delay > 0:
+            time.sleep(delay)
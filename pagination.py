@@ -5,38 +5,167 @@
     :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import json
+import hashlib
+
 from nereid.contrib.pagination import BasePagination
+from pyes.models import DotDict
 from trytond.pool import Pool
+from trytond.transaction import Transaction
 from werkzeug.utils import cached_property
 
+from cache import LRUCache
+
+
+class CachedResultSet(object):
+    """
+    The hits, total and facets of a `~pyes.es.ResultSet`, which unlike the
+    result set can be cached and pickled.
+    """
+
+    def __init__(self, total, hits, facets):
+        """
+        :param total: Number of documents matching the search
+        :param hits: List of the sources of the documents of the page
+        :param facets: Dictionary of the facets of the search
+        """
+        self.total = total
+        self.hits = hits
+        self.facets = facets
+
+    @classmethod
+    def from_result_set(cls, result_set):
+        return cls(
+            result_set.total,
+            [dict(hit) for hit in result_set],
+            result_set.facets
+        )
+
+    def count(self):
+        return self.total
+
+    def __len__(self):
+        return self.total
+
+    def __iter__(self):
+        return (DotDict(hit) for hit in self.hits)
+
 
 class ElasticPagination(BasePagination):
     """
     Specialized paginator class for Elasticsearch result sets. It takes a
     `~pyes.query.Search` object and performs the search using pagination
     capabilities.
+
+    If a `cache_key` identifying the search is given, the page of results is
+    cached for `result_cache_ttl` seconds, or until the index changes (see
+    `Configuration.get_index_version`). The results are cached in the
+    process, and in `shared_cache` if it is set to an object with `get(key)`
+    and `set(key, value, timeout)` methods (like the caches of
+    `werkzeug.contrib.cache`), so that the processes of the webshop share
+    them.
+
+    Only the `fields` of the source of the documents are fetched, by default
+    the `id` which is all `items` needs, as the sources of the products
+    (descriptions, tree nodes, prices of every price list) are large.
+
+    Unless `hydrate` is set, the items are not read from the database but
+    built from the documents by the `elastic_search_hits` classmethod of the
+    model, whose `get_elastic_search_hit_fields` are fetched.
     """
-    def __init__(self, model, search_obj, page, per_page):
+    #: Number of seconds the results are cached
+    result_cache_ttl = 300
+
+    #: Results cached in the process
+    result_cache = LRUCache(size=1000, ttl=result_cache_ttl)
+
+    #: Optional cache shared by the processes
+    shared_cache = None
+
+    def __init__(
+        self, model, search_obj, page, per_page, cache_key=None,
+        fields=('id',), hydrate=True
+    ):
         """
         :param model: Name of the tryton model on which the pagination is
                       happening.
         :param search_obj: The `~pyes.query.Search` object
         :param page: The page number
         :param per_page: Items per page
+        :param cache_key: A JSON serializable value identifying the search,
+                          like the normalized phrase and filters, to cache
+                          the results under
+        :param fields: The fields of the source of the documents to fetch,
+                       the whole source if `None`. `items` needs the `id`.
+        :param hydrate: Return the records of the hits from `items`, rather
+                        than objects built from the documents only
         """
         self.model_name = model
         self.search_obj = search_obj
+        self.cache_key = cache_key
+        self.hydrate = hydrate
+        if not hydrate:
+            fields = self.model.get_elastic_search_hit_fields()
+        self.fields = fields
         super(ElasticPagination, self).__init__(page, per_page)
 
     @property
     def model(self):
         return Pool().get(self.model_name)
 
+    def _get_result_cache_key(self):
+        """
+        Returns the key of the results in the caches, which includes the
+        version of the index so that the results cached before a change of
+        the index are not used anymore.
+        """
+        Configuration = Pool().get('elasticsearch.configuration')
+
+        return hashlib.sha1(json.dumps([
+            Transaction().cursor.dbname,
+            Configuration.get_index_version(),
+            self.model_name,
+            self.cache_key,
+            self.page,
+            self.per_page,
+            self.fields,
+        ])).hexdigest()
+
     @cached_property
     def result_set(self):
         """
         Generates the `~pyes.es.ResultSet` object after performing the search.
+
+        A `CachedResultSet` is returned instead when a `cache_key` is given.
+        """
+        if self.cache_key is None:
+            return self._search()
+
+        key = self._get_result_cache_key()
+        result_set = self.result_cache.get(key)
+        if result_set is None and self.shared_cache is not None:
+            result_set = self.shared_cache.get(key)
+            if result_set is not None:
+                self.result_cache.set(key, result_set)
+        if result_set is not None:
+            return result_set
+
+        result_set = CachedResultSet.from_result_set(self._search())
+        self.result_cache.set(key, result_set)
+        if self.shared_cache is not None:
+            self.shared_cache.set(key, result_set, self.result_cache_ttl)
+        return result_set
+
+    def _get_source_params(self, fields):
         """
+        Returns the parameters of a search request fetching only the given
+        fields of the source of the documents.
+        """
+        if fields is None:
+            return {}
+        return {'_source': ','.join(fields) if fields else 'false'}
+
+    def _search(self):
         config = Pool().get('elasticsearch.configuration')(1)
 
         conn = config.get_es_connection(timeout=5)
@@ -45,7 +174,8 @@ class ElasticPagination(BasePagination):
             self.search_obj,
             start=self.offset,
             size=self.per_page,
-            doc_types=[config.make_type_name(self.model_name)]
+            doc_types=[config.make_type_name(self.model_name)],
+            **self._get_source_params(self.fields)
         )
 
     @property
@@ -59,6 +189,8 @@ class ElasticPagination(BasePagination):
         """
         Returns items on the current page.
         """
+        if not self.hydrate:
+            return self.model.elastic_search_hits(self.result_set)
         return self.model.browse(
             map(lambda p: p.id, self.result_set)
         )
@@ -77,7 +209,8 @@ class ElasticPagination(BasePagination):
                     self.search_obj,
                     doc_types=[
                         config.make_type_name(self.model_name)
-                    ]
+                    ],
+                    **self._get_source_params(('id',))
                 )
             )
         )
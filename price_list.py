@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+    price_list.py
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from trytond.pool import Pool, PoolMeta
+
+__metaclass__ = PoolMeta
+__all__ = ['PriceList', 'PriceListLine']
+
+
+class PriceList:
+    __name__ = 'product.price_list'
+
+    @classmethod
+    def create(cls, vlist):
+        """
+        Update the prices of the indexed products on create
+        """
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+
+        price_lists = super(PriceList, cls).create(vlist)
+        IndexBacklog.create_from_records(price_lists)
+        return price_lists
+
+    @classmethod
+    def write(cls, price_lists, values, *args):
+        """
+        Update the prices of the indexed products on write
+        """
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+
+        rv = super(PriceList, cls).write(price_lists, values, *args)
+        IndexBacklog.create_from_records([
+            price_list for records in (price_lists,) + args[::2]
+            for price_list in records
+        ])
+        return rv
+
+    @classmethod
+    def delete(cls, price_lists):
+        """
+        Update the prices of the indexed products on delete
+        """
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+
+        IndexBacklog.create_from_records(price_lists)
+        return super(PriceList, cls).delete(price_lists)
+
+
+class PriceListLine:
+    __name__ = 'product.price_list.line'
+
+    @classmethod
+    def create(cls, vlist):
+        """
+        Update the prices of the indexed products on create
+        """
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+
+        lines = super(PriceListLine, cls).create(vlist)
+        IndexBacklog.create_from_records([line.price_list for line in lines])
+        return lines
+
+    @classmethod
+    def write(cls, lines, values, *args):
+        """
+        Update the prices of the indexed products on write
+        """
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+
+        rv = super(PriceListLine, cls).write(lines, values, *args)
+        IndexBacklog.create_from_records([
+            line.price_list for records in (lines,) + args[::2]
+            for line in records
+        ])
+        return rv
+
+    @classmethod
+    def delete(cls, lines):
+        """
+        Update the prices of the indexed products on delete
+        """
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+
+        IndexBacklog.create_from_records([line.price_list for line in lines])
+        return super(PriceListLine, cls).delete(lines)
@@ -5,73 +5,579 @@
     :copyright: (c) 2014-2015 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+from decimal import Decimal
+from collections import namedtuple
+
 from pyes import BoolQuery, MatchQuery, NestedQuery
-from pyes.filters import BoolFilter, ANDFilter, ORFilter, TermFilter
+from pyes.exceptions import ElasticSearchException
+from pyes.filters import Filter, BoolFilter, ANDFilter, ORFilter, TermFilter
 
+from trytond.cache import Cache
+from trytond.config import CONFIG
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
 from trytond.model import fields
 from trytond.pyson import Eval, Bool
 
-from nereid import request, template_filter
+from werkzeug.urls import url_quote
+
+from nereid import request, template_filter, url_for
+
+from indexer import BulkIndexer, chunks
+from cache import LRUCache
+from autocomplete import PrefixIndex, get_prefix_index
 
 __metaclass__ = PoolMeta
-__all__ = ['Product', 'Template']
+__all__ = ['Product', 'Template', 'Category', 'TreeNode']
+
+#: Faceting options of a filterable attribute, which unlike a
+#: `product.attribute` record can be kept across transactions.
+FilterableAttribute = namedtuple('FilterableAttribute', [
+    'id', 'name', 'multiselect', 'display_size', 'display_order',
+    'display_count',
+])
+
+#: Stand for the uri of a product, and the folder and name of an image, in
+#: the URLs built once per request for all the products, see
+#: `Product._es_product_url_builder`
+URI_PLACEHOLDER = '__uri__'
+FOLDER_PLACEHOLDER = '__folder__'
+NAME_PLACEHOLDER = '__name__'
+
+
+class CompiledFilter(Filter):
+    """
+    A `~pyes.filters.Filter` whose serialization was computed beforehand,
+    so that it can be shared by the searches with the same filters.
+
+    :param key: The canonical key of the filters, as returned by
+                `Product._normalize_es_filters`
+    :param data: The serialized filter, which must not be modified
+    """
+
+    def __init__(self, key, data):
+        super(CompiledFilter, self).__init__()
+        self.key = key
+        self.data = data
+
+    def serialize(self):
+        return self.data
+
+
+class ProductHit(object):
+    """
+    A product of the search results, built from its document rather than
+    read from the database, for the listings rendered from the index only.
+    It has the attributes and methods of `product.product` that a listing
+    card needs.
+    """
+
+    def __init__(self, id, name, code, price, url, image_url):
+        self.id = id
+        self.name = name
+        self.code = code
+        self.price = price
+        self.url = url
+        self.image_url = image_url
+
+    def get_absolute_url(self, **kwargs):
+        return self.url
+
+    def sale_price(self, quantity=0):
+        return self.price
 
 
 class Product:
     __name__ = 'product.product'
 
+    #: Serialized filters by canonical key, see `_build_es_filter`
+    _es_filter_cache = LRUCache(size=1024)
+
+    @classmethod
+    def create(cls, vlist):
+        """
+        Create a record in elastic search on create
+        :param vlist: List of dictionaries of fields with values
+        """
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+
+        products = super(Product, cls).create(vlist)
+        IndexBacklog.create_from_records(products)
+        return products
+
+    @classmethod
+    def get_elastic_search_fields(cls):
+        """
+        Return the set of product fields which feed the document of the
+        product. Writing any other field does not reindex the product.
+        Downstream modules which add product fields to the document should
+        extend this set.
+        """
+        return set([
+            'template', 'code', 'description', 'use_template_description',
+            'displayed_on_eshop', 'active', 'nodes', 'attributes', 'uri',
+            'image_sets', 'use_template_images',
+        ])
+
+    @classmethod
+    def write(cls, products, values, *args):
+        """
+        Update the record in elastic search on write, if any of the fields
+        used in the search document changed.
+        """
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+
+        rv = super(Product, cls).write(products, values, *args)
+
+        es_fields = cls.get_elastic_search_fields()
+        actions = iter((products, values) + args)
+
+        changed = []
+        for records, written in zip(actions, actions):
+            if es_fields.intersection(written):
+                changed.extend(records)
+        IndexBacklog.create_from_records(changed)
+        return rv
+
+    @classmethod
+    def delete(cls, products):
+        """
+        Delete the record from elastic search on delete. The deletions are
+        sent in bulk when the backlog is processed.
+        """
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+
+        IndexBacklog.create_from_records(products)
+        return super(Product, cls).delete(products)
+
     def elastic_search_json(self):
         """
         Return a JSON serializable dictionary
         """
-        PriceList = Pool().get('product.price_list')
-        User = Pool().get('res.user')
+        return self._elastic_search_json_batch([self])[0]
+
+    @classmethod
+    def elastic_search_json_batch(cls, products):
+        """
+        Return a list of JSON serializable dictionaries, one for each of the
+        given products and in the same order.
 
-        if self.use_template_description:
-            description = self.template.description
-        else:  # pragma: no cover
-            description = self.description
+        The templates, categories, tree nodes and price lists of all the
+        products are read in a few bulk reads instead of being loaded lazily
+        record by record, which makes this the method to use when indexing
+        many products. Downstream modules which add fields to the document
+        should extend this method.
 
-        price_lists = PriceList.search([])
-        price_list_data = []
+        Downstream modules which extend `elastic_search_json` instead (the
+        extension point of the `elastic_search` module) are still honoured:
+        the documents are then built product by product with it.
 
-        company = User(Transaction().user).company
+        :param products: List of product active records
+        """
+        if cls.elastic_search_json.im_func is not \
+                Product.elastic_search_json.im_func:
+            return [
+                product.elastic_search_json()
+                for product in cls.browse([p.id for p in products])
+            ]
+        return cls._elastic_search_json_batch(products)
 
-        for _list in price_lists:
-            price_list_data.append({
-                'id': _list.id,
-                'price': _list.compute(
-                    company.party, self, self.list_price, 1,
-                    self.default_uom
-                )
+    @classmethod
+    def _elastic_search_json_batch(cls, products):
+        pool = Pool()
+        Template = pool.get('product.template')
+        Category = pool.get('product.category')
+        ProductNode = pool.get('product.product-product.tree_node')
+        TreeNode = pool.get('product.tree_node')
+
+        products = cls.browse([p.id for p in products])
+        product_ids = [p.id for p in products]
+
+        product_rows = dict((row['id'], row) for row in cls.read(
+            product_ids, [
+                'template', 'code', 'description', 'use_template_description',
+                'displayed_on_eshop', 'active', 'nodes', 'uri',
+                'default_image',
+            ]
+        ))
+        template_rows = dict((row['id'], row) for row in Template.read(
+            list(set(row['template'] for row in product_rows.values())), [
+                'name', 'description', 'list_price', 'type', 'category',
+            ]
+        ))
+        category_names = dict((row['id'], row['name']) for row in Category.read(
+            list(set(
+                row['category'] for row in template_rows.values()
+                if row['category']
+            )), ['name']
+        ))
+        node_rows = ProductNode.read(list(set(
+            node_id for row in product_rows.values() for node_id in row['nodes']
+        )), ['node', 'sequence'])
+        node_names = dict((row['id'], row['name']) for row in TreeNode.read(
+            list(set(row['node'] for row in node_rows)), ['name']
+        ))
+        node_rows = dict((row['id'], row) for row in node_rows)
+
+        price_list_matrix = cls.get_price_list_matrix(products)
+        images = cls.get_elastic_search_images(product_rows.values())
+
+        documents = []
+        for product in products:
+            row = product_rows[product.id]
+            template = template_rows[row['template']]
+
+            if row['use_template_description']:
+                description = template['description']
+            else:  # pragma: no cover
+                description = row['description']
+
+            documents.append({
+                'id': product.id,
+                'name': template['name'],
+                'code': row['code'],
+                'description': description,
+                'list_price': template['list_price'],
+                'category': {
+                    'id': template['category'],
+                    'name': category_names[template['category']],
+                } if template['category'] else {},
+                'tree_nodes': [{
+                    'id': node_id,
+                    'name': node_names[node_rows[node_id]['node']],
+                    'sequence': node_rows[node_id]['sequence'],
+                } for node_id in row['nodes']],
+                'type': template['type'],
+                'price_lists': price_list_matrix[product.id],
+                'displayed_on_eshop': (
+                    "true" if row['displayed_on_eshop'] else "false"
+                ),
+                'active': "true" if row['active'] else "false",
+                'uri': row['uri'],
+                'image': images.get(row['default_image'], {}),
+                'attributes': product.get_elastic_filterable_data(),
             })
+            if row['active'] and row['displayed_on_eshop']:
+                documents[-1]['suggest'] = {
+                    'input': cls.elastic_search_suggest_inputs(
+                        template['name'], row['code']
+                    ),
+                    'output': template['name'],
+                    'payload': {'id': product.id, 'uri': row['uri']},
+                }
+        return documents
+
+    @classmethod
+    def get_elastic_search_images(cls, product_rows):
+        """
+        Return a dictionary which maps the id of the default image of the
+        given products to its `image` section of the document: the `folder`
+        and `name` of a local file, or the `url` of a remote one.
+
+        :param product_rows: List of dictionaries of the product values
+                             read, with the `default_image`
+        """
+        pool = Pool()
+        StaticFile = pool.get('nereid.static.file')
+        StaticFolder = pool.get('nereid.static.folder')
+
+        file_rows = StaticFile.read(list(set(
+            row['default_image'] for row in product_rows
+            if row['default_image']
+        )), ['name', 'folder', 'type', 'remote_path'])
+        folder_names = dict(
+            (row['id'], row['folder_name']) for row in StaticFolder.read(
+                list(set(row['folder'] for row in file_rows)),
+                ['folder_name']
+            )
+        )
+        return dict((row['id'], {
+            'folder': folder_names[row['folder']],
+            'name': row['name'],
+        } if row['type'] == 'local' else {
+            'url': row['remote_path'],
+        }) for row in file_rows)
+
+    @staticmethod
+    def elastic_search_suggest_inputs(name, code):
+        """
+        Return the list of the texts whose prefixes complete to the product
+        in the `suggest` completion field: the name and every end of the
+        name starting at a word, so that any word of the name can be typed
+        first, and the code.
+        """
+        words = (name or '').split()
+        inputs = [' '.join(words[i:]) for i in xrange(len(words))]
+        if code:
+            inputs.append(code)
+        return inputs
+
+    @classmethod
+    def elastic_search_documents(cls, chunk_size=500):
+        """
+        Yield the documents of all the products, serialized in chunks of
+        `chunk_size` products read one after the other, so that the whole
+        catalog is never loaded at once.
+        """
+        last_id = 0
+        while True:
+            products = cls.search(
+                [('id', '>', last_id)], order=[('id', 'ASC')],
+                limit=chunk_size
+            )
+            if not products:
+                return
+            for document in cls.elastic_search_json_batch(products):
+                yield document
+            last_id = products[-1].id
+
+    @classmethod
+    def elastic_search_bulk_index(cls, products, indexer=None, chunk_size=500):
+        """
+        Serialize the given products in chunks of `chunk_size` and stream
+        their documents into elasticsearch `_bulk` requests.
+
+        Returns the `BulkIndexer` used, after flushing it, so that the caller
+        can inspect the `errors` of the actions which failed.
+
+        :param products: Iterable of product active records
+        :param indexer: The `BulkIndexer` to use. By default one for the
+                        index of the configuration is created.
+        :param chunk_size: Number of products serialized together
+        """
+        if indexer is None:
+            indexer = BulkIndexer.from_config(
+                cls.__name__, chunk_size=chunk_size
+            )
+
+        for chunk in chunks(products, chunk_size):
+            for document in cls.elastic_search_json_batch(chunk):
+                indexer.index(document['id'], document)
+        indexer.flush()
+
+        return indexer
+
+    @classmethod
+    def elastic_search_prices_batch(cls, products):
+        """
+        Return the price fragments (`list_price` and `price_lists`) of the
+        documents of the given products, as a list of dictionaries which also
+        hold the `id` of each product.
+
+        :param products: List of product active records
+        """
+        products = cls.browse([p.id for p in products])
+        price_list_matrix = cls.get_price_list_matrix(products)
+
+        return [{
+            'id': product.id,
+            'list_price': product.list_price,
+            'price_lists': price_list_matrix[product.id],
+        } for product in products]
+
+    @classmethod
+    def get_elastic_search_partial_updates(cls):
+        """
+        Return a dictionary which maps the name of every model whose backlog
+        entries update only a part of the product documents to a tuple of:
+
+            * the path of the product field linking to its records, or None
+              if a change affects all the products.
+            * the name of the classmethod returning the updated fragments of
+              a list of products (see `elastic_search_prices_batch`).
+
+        Other changes to templates add the products themselves to the
+        backlog, so the entries of templates only update the prices.
+        """
+        dependencies = cls.get_elastic_search_dependencies()
 
         return {
-            'id': self.id,
-            'name': self.name,
-            'code': self.code,
-            'description': description,
-            'list_price': self.list_price,
+            'product.price_list': (None, 'elastic_search_prices_batch'),
+            'product.template': (
+                dependencies['product.template'],
+                'elastic_search_prices_batch'
+            ),
+            'product.category': (
+                dependencies['product.category'],
+                'elastic_search_category_batch'
+            ),
+            'product.tree_node': (
+                dependencies['product.tree_node'],
+                'elastic_search_tree_nodes_batch'
+            ),
+            'product.attribute': (
+                dependencies['product.attribute'],
+                'elastic_search_attributes_batch'
+            ),
+        }
+
+    @classmethod
+    def elastic_search_category_batch(cls, products):
+        """
+        Return the `category` fragments of the documents of the given
+        products, along with their `id`.
+        """
+        return [{
+            'id': product.id,
             'category': {
-                'id': self.category.id,
-                'name': self.category.name,
-            } if self.category else {},
+                'id': product.category.id,
+                'name': product.category.name,
+            } if product.category else {},
+        } for product in cls.browse([p.id for p in products])]
+
+    @classmethod
+    def elastic_search_tree_nodes_batch(cls, products):
+        """
+        Return the `tree_nodes` fragments of the documents of the given
+        products, along with their `id`.
+        """
+        return [{
+            'id': product.id,
             'tree_nodes': [{
                 'id': node.id,
                 'name': node.node.name,
                 'sequence': node.sequence,
-            } for node in self.nodes],
-            'type': self.type,
-            'price_lists': price_list_data,
-            'displayed_on_eshop': (
-                "true" if self.displayed_on_eshop else "false"
-            ),
-            'active': "true" if self.active else "false",
-            'attributes': self.get_elastic_filterable_data(),
+            } for node in product.nodes],
+        } for product in cls.browse([p.id for p in products])]
+
+    @classmethod
+    def elastic_search_attributes_batch(cls, products):
+        """
+        Return the `attributes` fragments of the documents of the given
+        products, along with their `id`.
+        """
+        return [{
+            'id': product.id,
+            'attributes': product.get_elastic_filterable_data(),
+        } for product in cls.browse([p.id for p in products])]
+
+    @classmethod
+    def elastic_search_update_partial(
+        cls, model_name, record_ids, indexer, chunk_size=500
+    ):
+        """
+        Send partial updates of the documents of the products related to the
+        given records of a model listed by
+        `get_elastic_search_partial_updates`, in chunks of `chunk_size`, and
+        return the ids of the products updated.
+
+        :param model_name: Name of the model of the changed records
+        :param record_ids: Ids of the changed records
+        :param indexer: The `BulkIndexer` of the product documents
+        """
+        path, method_name = cls.get_elastic_search_partial_updates()[
+            model_name
+        ]
+        domain = [(path, 'in', list(record_ids))] if path else []
+
+        products = cls.search(domain)
+        for chunk in chunks(products, chunk_size):
+            for fragment in getattr(cls, method_name)(chunk):
+                indexer.update(fragment.pop('id'), fragment)
+        indexer.flush()
+
+        return [product.id for product in products]
+
+    @classmethod
+    def get_price_list_matrix(cls, products):
+        """
+        Return a dictionary which maps the id of every given product to the
+        list of its prices on each price list, in the format used by the
+        `price_lists` section of the document.
+
+        The price lists and the company party are looked up only once for the
+        whole batch and each price list instance (and hence its rules) is
+        reused across all the products, so indexing code serializing many
+        products should call this once per chunk rather than once per product.
+
+        A price list without any line for a specific product gives the same
+        price to the products with the same `_get_price_list_key` (the
+        variants of a template), so it is computed once for them.
+
+        :param products: List of product active records
+        """
+        PriceList = Pool().get('product.price_list')
+        User = Pool().get('res.user')
+
+        price_lists = PriceList.search([])
+        party = User(Transaction().user).company.party
+
+        matrix = dict((product.id, []) for product in products)
+        for _list in price_lists:
+            shared = not any(line.product for line in _list.lines)
+            prices = {}
+            for product in products:
+                if shared:
+                    key = cls._get_price_list_key(product)
+                else:
+                    key = product.id
+                if key not in prices:
+                    prices[key] = _list.compute(
+                        party, product, product.list_price, 1,
+                        product.default_uom
+                    )
+                matrix[product.id].append({
+                    'id': _list.id,
+                    'price': prices[key],
+                })
+        return matrix
+
+    @staticmethod
+    def _get_price_list_key(product):
+        """
+        Return the values which the price of the product on a price list
+        without product specific lines depends on. Downstream modules whose
+        price lists match on other fields of the product should extend it.
+        """
+        return (
+            product.template.id, product.list_price, product.default_uom.id,
+            product.category.id if product.category else None,
+        )
+
+    @classmethod
+    def get_elastic_search_dependencies(cls):
+        """
+        Return a dictionary which maps the name of every model, other than
+        the product itself, whose records are part of the product documents
+        to the path of the product field which links to them. Downstream
+        modules which add related records to the document should extend it.
+        """
+        return {
+            'product.template': 'template',
+            'product.category': 'template.category',
+            'product.product-product.tree_node': 'nodes',
+            'product.tree_node': 'nodes.node',
+            'product.attribute': 'template.attribute_set.attributes',
         }
 
+    @classmethod
+    def search_elastic_search_changed(cls, since):
+        """
+        Return the products whose document may have changed since the given
+        datetime, because the product or any of the records its document is
+        built from (see `get_elastic_search_dependencies`) was created or
+        written. Inactive products are included, so that deactivated
+        products can be removed from the index.
+        """
+        pool = Pool()
+
+        changed = [
+            'OR',
+            ('create_date', '>=', since),
+            ('write_date', '>=', since),
+        ]
+        domain = ['OR', changed]
+
+        with Transaction().set_context(active_test=False):
+            for model_name, path in \
+                    cls.get_elastic_search_dependencies().iteritems():
+                Model = pool.get(model_name)
+                ids = [record.id for record in Model.search(changed)]
+                if ids:
+                    domain.append((path, 'in', ids))
+
+            return cls.search(domain)
+
     def get_elastic_filterable_data(self):
         """
         This method returns a dictionary of attributes which will be used to
@@ -87,10 +593,14 @@ class Product:
         This method returns a list of filterable product attributes, which can
         be used in faceting and aggregation. Downstream modules can override
         this method to add any extra filterable fields.
+
+        The attributes are `FilterableAttribute` tuples, cached until a
+        product attribute changes, so that searching does not query the
+        database for them.
         """
         Attribute = Pool().get('product.attribute')
 
-        return Attribute.search([('filterable', '=', True)])
+        return Attribute.get_filterable()
 
     @classmethod
     def _update_es_facets(
@@ -165,10 +675,57 @@ class Product:
         )
 
     @classmethod
-    def _build_es_filter(cls, filterable_attributes=None):
+    def _normalize_es_filters(cls, filterable_attributes, filters=None):
+        """
+        Return the canonical key of the filters on the filterable attributes:
+        a tuple of (attribute name, tuple of values) sorted by name, with
+        sorted and unique values. The filters on other names are ignored.
+
+        >>> Product._normalize_es_filters(
+        ...     attributes, {'size': ['xl', 'l', 'xl'], 'color': 'blue'}
+        ... )
+        (('color', ('blue',)), ('size', ('l', 'xl')))
+
+        :param filterable_attributes: The list of filterable attributes
+        :param filters: A dictionary of the values (a list or a single
+                        value) to filter on by attribute name, the query
+                        string of the request if not given
+        """
+        if filters is None:
+            filters = dict(
+                (key, request.args.getlist(key)) for key in request.args
+            )
+
+        names = set(attribute.name for attribute in filterable_attributes)
+
+        key = []
+        for name, values in filters.iteritems():
+            if name not in names:
+                continue
+            if isinstance(values, basestring):
+                values = [values]
+            if values:
+                key.append((name, tuple(sorted(set(values)))))
+        return tuple(sorted(key))
+
+    @classmethod
+    def _compile_es_filter(cls, key):
+        """
+        Return the serialization of the filter of the given canonical key
+        (see `_normalize_es_filters`), which should be cached since building
+        and serializing the `~pyes.filters.Filter` objects is expensive.
+        """
+        return BoolFilter(must=ANDFilter([
+            ORFilter([TermFilter(name, value) for value in values])
+            for name, values in key
+        ])).serialize()
+
+    @classmethod
+    def _build_es_filter(cls, filterable_attributes=None, filters=None):
         """
         This method generates a `~pyes.filters.Filter` object from the
-        request.args dictionary. This is then used to refine the search.
+        request.args dictionary (or the given filters). This is then used to
+        refine the search.
 
         For example, if the query string is -:
             "/search?q=product&color=black&color=blue&size=xl"
@@ -190,37 +747,32 @@ class Product:
             )
         >>> main_filter = BoolFilter().add_must(and_filter)
 
+        The filter is returned as a `CompiledFilter`, whose serialization is
+        cached by the canonical key of the filters (see
+        `_normalize_es_filters`), so the same filters in a different order
+        reuse the same serialization.
+
         If there are no filters applied in the query string, `None` is returned.
+
+        :param filterable_attributes: The list of filterable attributes
+        :param filters: A dictionary of the values to filter on by attribute
+                        name, instead of the query string of the request
         """
         # If no filterable attributes defined in database, return None.
         if not filterable_attributes:
             return None
 
-        # Search for the attribute name in list of filterable attributes.
-        # If present (meaning it is a valid argument), add as TermFilter.
-        main_filter = BoolFilter()
-        and_filter_list = []
-
-        filterable_attr_names = map(lambda x: x.name, filterable_attributes)
-
-        for key in request.args:
-            if key in filterable_attr_names:
-                or_filter = ORFilter(
-                    [
-                        TermFilter(key, value) for value
-                        in request.args.getlist(key)
-                    ]
-                )
-                and_filter_list.append(or_filter)
+        key = cls._normalize_es_filters(filterable_attributes, filters)
 
         # If no filterable attributes were found in query string
-        if not and_filter_list:
+        if not key:
             return None
 
-        and_filter = ANDFilter(and_filter_list)
-        main_filter.add_must(and_filter)
-
-        return main_filter
+        data = cls._es_filter_cache.get(key)
+        if data is None:
+            data = cls._compile_es_filter(key)
+            cls._es_filter_cache.set(key, data)
+        return CompiledFilter(key, data)
 
     @classmethod
     @template_filter('add_display_counts')
@@ -233,24 +785,15 @@ class Product:
         """
         ProductAttribute = Pool().get('product.attribute')
 
-        display_count_attrs = map(lambda x: x.name, ProductAttribute.search([
-            ('display_count', '=', True)
-        ]))
+        display_count_attrs = ProductAttribute.get_display_count_names()
 
         for key, value in facets.iteritems():
-            if key in display_count_attrs:
-                value.update({
-                    'display_count': True
-                })
-            else:
-                value.update({
-                    'display_count': False
-                })
+            value['display_count'] = key in display_count_attrs
         return facets
 
     @classmethod
     def _quick_search_es(
-        cls, search_phrase, autocomplete=False
+        cls, search_phrase, autocomplete=False, filters=None
     ):
         """
         Searches on elasticsearch server for given search phrase.
@@ -282,6 +825,8 @@ class Product:
         :param limit: The number of records to be returned
         :param autocomplete: A boolean which is set to True if the request
         comes from the autocomplete web handler
+        :param filters: A dictionary of the values to filter on by attribute
+        name, the query string of the request is used if not given
         :returns: `~pyes.es.ResultSet` object which contains each product's
         attributes
         """
@@ -289,7 +834,7 @@ class Product:
 
         # Create the filter.
         es_filter = cls._build_es_filter(
-            filterable_attributes=filterable_attributes
+            filterable_attributes=filterable_attributes, filters=filters
         )
 
         # Generate the `~pyes.query.Query` object.
@@ -317,10 +862,172 @@ class Product:
         The product's URL is generated here as request context is available
         here. This is sent to the front-end for typeaheadJS to compile into
         its suggestions template.
+
+        The suggestions come from the `suggest` completion field of the
+        documents, which only costs a lookup in memory on the cluster. The
+        full search is used if the index has no such field yet.
         """
         config = Pool().get('elasticsearch.configuration')(1)
 
         conn = config.get_es_connection(timeout=5)
+
+        try:
+            response = conn._send_request(
+                'POST', '/%s/_suggest' % config.get_index_name(name=None), {
+                    'products': {
+                        'text': phrase,
+                        'completion': {'field': 'suggest', 'size': 5},
+                    },
+                }
+            )
+        except ElasticSearchException:
+            config.get_logger().warning(
+                "Completion suggester failed, rebuild the index to add the "
+                "suggest field", exc_info=True
+            )
+            return cls._es_autocomplete_search(phrase)
+
+        product_url = cls._es_product_url_builder()
+        return [{
+            "display_name": option['text'],
+            "url": product_url(option['payload']['uri']),
+        } for suggestion in response['products']
+            for option in suggestion['options']]
+
+    @classmethod
+    def _prefix_autocomplete(cls, phrase):
+        """
+        Auto-completion from the in-process prefix index of the product
+        names (see `autocomplete.PrefixIndex`), if it is enabled with the
+        `elastic_search_prefix_index` option of the configuration file.
+
+        Returns `None` when it is disabled, not built yet or has no match,
+        for the elasticsearch autocompletion to be used instead.
+        """
+        if not CONFIG.get('elastic_search_prefix_index'):
+            return None
+
+        index = cls._get_prefix_index()
+        if not index.ready:
+            return None
+        suggestions = index.search(phrase)
+        if not suggestions:
+            return None
+
+        product_url = cls._es_product_url_builder()
+        return [{
+            "display_name": suggestion['display_name'],
+            "url": product_url(suggestion['uri']),
+        } for suggestion in suggestions]
+
+    @classmethod
+    def _get_prefix_index(cls):
+        """
+        Return the prefix index of the products of the database, after
+        starting its refresh in a background thread if the version of the
+        elasticsearch index changed. The index is built by a background
+        thread too, the first time.
+        """
+        Configuration = Pool().get('elasticsearch.configuration')
+
+        def factory():
+            config = Configuration(1)
+            return PrefixIndex(
+                config.get_es_connection(),
+                config.get_index_name(name=None),
+                config.make_type_name(cls.__name__)
+            )
+        index = get_prefix_index(Transaction().cursor.dbname, factory)
+        index.refresh_in_background(
+            Configuration.get_index_version(), Configuration.get_logger()
+        )
+        return index
+
+    @classmethod
+    def get_elastic_search_hit_fields(cls):
+        """
+        Return the list of the fields of the documents which
+        `elastic_search_hits` needs.
+        """
+        return [
+            'id', 'name', 'code', 'uri', 'list_price', 'price_lists', 'image',
+        ]
+
+    @classmethod
+    def elastic_search_hits(cls, documents):
+        """
+        Return a `ProductHit` for each of the given documents, with the price
+        of the price list of the visitor, without reading the products.
+
+        :param documents: Iterable of the documents of search hits, with the
+                          fields of `get_elastic_search_hit_fields`
+        """
+        Sale = Pool().get('sale.sale')
+
+        price_list = Sale.default_price_list()
+        product_url = cls._es_product_url_builder()
+        image_url = cls._es_image_url_builder()
+
+        hits = []
+        for document in documents:
+            prices = dict(
+                (entry['id'], entry['price'])
+                for entry in document.price_lists or []
+            )
+            price = prices.get(price_list, document.list_price)
+            hits.append(ProductHit(
+                document.id, document.name, document.code,
+                Decimal(str(price)) if price is not None else None,
+                product_url(document.uri), image_url(document.image)
+            ))
+        return hits
+
+    @staticmethod
+    def _es_image_url_builder():
+        """
+        Return a function building the URL of an image from its `image`
+        section of a document, like `_es_product_url_builder`.
+        """
+        template = url_for(
+            'nereid.static.file.send_static_file',
+            folder=FOLDER_PLACEHOLDER, name=NAME_PLACEHOLDER
+        )
+
+        def image_url(image):
+            if not image:
+                return None
+            if 'url' in image:
+                return image['url']
+            return template.replace(
+                FOLDER_PLACEHOLDER, url_quote(image['folder'])
+            ).replace(NAME_PLACEHOLDER, url_quote(image['name']))
+        return image_url
+
+    @staticmethod
+    def _es_product_url_builder():
+        """
+        Return a function building the absolute URL of a product, for the
+        website and locale of the current request, from its uri.
+
+        `url_for` is called once with a placeholder uri, instead of once per
+        product, since routing is much slower than replacing a string.
+        """
+        template = url_for(
+            'product.product.render', uri=URI_PLACEHOLDER, _external=True
+        )
+        return lambda uri: template.replace(URI_PLACEHOLDER, url_quote(uri))
+
+    @classmethod
+    def _es_autocomplete_search(cls, phrase):
+        """
+        Auto-completion with the full search, for indices without the
+        `suggest` completion field. The suggestions are built from the
+        `name` and `uri` of the documents, without reading the products.
+        """
+        config = Pool().get('elasticsearch.configuration')(1)
+
+        conn = config.get_es_connection(timeout=5)
+        product_url = cls._es_product_url_builder()
         results = []
 
         search_obj = cls._quick_search_es(phrase, autocomplete=True)
@@ -331,12 +1038,15 @@ class Product:
             doc_types=[config.make_type_name('product.product')],
             size=5
         ):
+            if product.uri is not None:
+                url = product_url(product.uri)
+            else:  # pragma: no cover
+                # Indexed before the uri was added to the documents
+                url = cls(product.id).get_absolute_url(_external=True)
             results.append(
                 {
                     "display_name": product.name,
-                    "url": cls(product.id).get_absolute_url(
-                        _external=True
-                    ),
+                    "url": url,
                 }
             )
 
@@ -362,26 +1072,141 @@ class Template:
         IndexBacklog.create_from_records(products)
         return templates
 
+    @classmethod
+    def delete(cls, templates):
+        """
+        Delete the records of the products from elastic search on delete
+        """
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+
+        IndexBacklog.create_from_records(
+            [p for template in templates for p in template.products]
+        )
+        return super(Template, cls).delete(templates)
+
+    @classmethod
+    def get_elastic_search_fields(cls):
+        """
+        Return the set of template fields which feed the documents of its
+        products. Writing any other field (cost price, accounts, ...) does
+        not reindex the products. Downstream modules which add template
+        fields to the document should extend this set.
+        """
+        return set([
+            'name', 'description', 'list_price', 'type', 'category',
+            'default_uom', 'active', 'products', 'image_sets',
+        ])
+
+    @classmethod
+    def get_elastic_search_price_fields(cls):
+        """
+        Return the subset of `get_elastic_search_fields` which only feed the
+        prices of the documents. Writes limited to these fields update just
+        the prices of the documents.
+        """
+        return set(['list_price'])
+
     @classmethod
     def write(cls, templates, values, *args):
         """
-        Create a record in elastic search on write
+        Create a record in elastic search on write, if any of the fields
+        used in the search document changed. If only prices changed, the
+        template is added to the backlog to update just the prices.
         """
         IndexBacklog = Pool().get('elasticsearch.index_backlog')
         Product = Pool().get('product.product')
 
         rv = super(Template, cls).write(templates, values, *args)
 
-        products = []
-        for template in templates:
-            products.extend([Product(p) for p in template.products])
-        IndexBacklog.create_from_records(products)
+        es_fields = cls.get_elastic_search_fields()
+        price_fields = cls.get_elastic_search_price_fields()
+        actions = iter((templates, values) + args)
+
+        products, price_templates = [], []
+        for records, written in zip(actions, actions):
+            indexed = es_fields.intersection(written)
+            if not indexed:
+                continue
+            if indexed <= price_fields:
+                price_templates.extend(records)
+                continue
+            for template in records:
+                products.extend([Product(p) for p in template.products])
+        IndexBacklog.create_from_records(products + price_templates)
+        return rv
+
+
+class Category:
+    __name__ = 'product.category'
+
+    @classmethod
+    def write(cls, categories, values, *args):
+        """
+        Update the category of the documents of the products on write
+        """
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+
+        rv = super(Category, cls).write(categories, values, *args)
+
+        actions = iter((categories, values) + args)
+        IndexBacklog.create_from_records([
+            category for records, written in zip(actions, actions)
+            if 'name' in written for category in records
+        ])
         return rv
 
+    @classmethod
+    def delete(cls, categories):
+        """
+        Reindex the products of the categories on delete
+        """
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+        Product = Pool().get('product.product')
+
+        IndexBacklog.create_from_records(Product.search([
+            ('template.category', 'in', [c.id for c in categories]),
+        ]))
+        return super(Category, cls).delete(categories)
+
+
+class TreeNode:
+    __name__ = 'product.tree_node'
+
+    @classmethod
+    def write(cls, nodes, values, *args):
+        """
+        Update the tree nodes of the documents of the products on write
+        """
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+
+        rv = super(TreeNode, cls).write(nodes, values, *args)
+
+        actions = iter((nodes, values) + args)
+        IndexBacklog.create_from_records([
+            node for records, written in zip(actions, actions)
+            if 'name' in written for node in records
+        ])
+        return rv
+
+    @classmethod
+    def delete(cls, nodes):
+        """
+        Reindex the products of the tree nodes on delete
+        """
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+        Product = Pool().get('product.product')
+
+        IndexBacklog.create_from_records(Product.search([
+            ('nodes.node', 'in', [n.id for n in nodes]),
+        ]))
+        return super(TreeNode, cls).delete(nodes)
+
 
 class ProductAttribute:
     __name__ = 'product.attribute'
 
+    _filterable_cache = Cache('product.attribute.filterable', context=False)
+
     filterable = fields.Boolean(
         'Filterable', select=True,
         help="Makes the attribute filterable in faceted navigation"
@@ -425,6 +1250,86 @@ class ProductAttribute:
         depends=['filterable']
     )
 
+    @classmethod
+    def get_filterable(cls):
+        """
+        Returns a tuple of the `FilterableAttribute` of the filterable
+        attributes, from a cache of the database which is cleared whenever
+        an attribute is created, written or deleted.
+        """
+        attributes = cls._filterable_cache.get(None)
+        if attributes is not None:
+            return attributes
+
+        attributes = tuple(
+            FilterableAttribute(
+                attribute.id, attribute.name, attribute.multiselect,
+                attribute.display_size, attribute.display_order,
+                attribute.display_count
+            ) for attribute in cls.search([('filterable', '=', True)])
+        )
+        cls._filterable_cache.set(None, attributes)
+        return attributes
+
+    @classmethod
+    def get_display_count_names(cls):
+        """
+        Returns the frozenset of the names of the filterable attributes
+        whose facets display the number of matching products, cached along
+        with `get_filterable`.
+        """
+        names = cls._filterable_cache.get('display_count')
+        if names is not None:
+            return names
+
+        names = frozenset(
+            attribute.name for attribute in cls.get_filterable()
+            if attribute.display_count
+        )
+        cls._filterable_cache.set('display_count', names)
+        return names
+
+    @classmethod
+    def create(cls, vlist):
+        attributes = super(ProductAttribute, cls).create(vlist)
+        cls._filterable_cache.clear()
+        return attributes
+
+    @classmethod
+    def delete(cls, attributes):
+        super(ProductAttribute, cls).delete(attributes)
+        cls._filterable_cache.clear()
+
+    @classmethod
+    def get_elastic_search_fields(cls):
+        """
+        Return the set of attribute fields which feed the documents of the
+        products. The `attributes` of the documents are the values stored on
+        the products (see `product.product.get_elastic_filterable_data`), so
+        none by default. Downstream modules which add attribute fields to the
+        documents should extend this set.
+        """
+        return set()
+
+    @classmethod
+    def write(cls, attributes, values, *args):
+        """
+        Update the attributes of the documents of the products on write, if
+        any of the fields used in the documents changed.
+        """
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+
+        rv = super(ProductAttribute, cls).write(attributes, values, *args)
+        cls._filterable_cache.clear()
+
+        es_fields = cls.get_elastic_search_fields()
+        actions = iter((attributes, values) + args)
+        IndexBacklog.create_from_records([
+            attribute for records, written in zip(actions, actions)
+            if es_fields.intersection(written) for attribute in records
+        ])
+        return rv
+
     @staticmethod
     def default_filterable():
         return True
@@ -12,6 +12,8 @@ import trytond.tests.test_tryton
 from tests.test_views_depends import TestViewsDepends
 from tests.test_product import TestProduct
 from tests.test_pagination import TestPagination
+from tests.test_es_commands import TestCommands
+from tests.test_indexer import TestThrottle
 
 
 def suite():
@@ -23,6 +25,8 @@ def suite():
         unittest.TestLoader().loadTestsFromTestCase(TestViewsDepends),
         unittest.TestLoader().loadTestsFromTestCase(TestProduct),
         unittest.TestLoader().loadTestsFromTestCase(TestPagination),
+        unittest.TestLoader().loadTestsFromTestCase(TestCommands),
+        unittest.TestLoader().loadTestsFromTestCase(TestThrottle),
     ])
     return test_suite
 
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_es_commands.py
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import unittest
+from itertools import imap
+from datetime import datetime
+from StringIO import StringIO
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import DB_NAME
+from trytond.config import CONFIG
+
+import es_commands
+from es_commands import partition, get_range_domain, transaction, \
+    _get_id_ranges, _reindex_worker, _create_index_generation, \
+    _swap_index_alias, reindex, rebuild, work, get_parser, main, \
+    _export_command, _load_command
+from indexer import Throttle
+
+CONFIG['elastic_search_server'] = "http://localhost:9200"
+
+
+def in_range(record_id, lo, hi):
+    return (lo is None or lo <= record_id) and (hi is None or record_id < hi)
+
+
+class InProcessPool(object):
+    """
+    Stands for `multiprocessing.Pool`, running the tasks in the calling
+    process so that they run in the test database.
+    """
+
+    def __init__(self, processes=None):
+        self.processes = processes
+
+    def imap_unordered(self, func, iterable):
+        return imap(func, iterable)
+
+    def apply(self, func, args=()):
+        return func(*args)
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class InProcessMultiprocessing(object):
+    "Stands for the `multiprocessing` module in `es_commands`"
+
+    Pool = InProcessPool
+
+    @staticmethod
+    def cpu_count():
+        return 2
+
+
+class FakeTime(object):
+    "Stands for the `time` module in `es_commands`, without sleeping"
+
+    def __init__(self):
+        self.sleeps = []
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+    def time(self):
+        return time.time()
+
+
+class TestCommands(unittest.TestCase):
+    "Test the command line maintenance of the index"
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module(
+            'nereid_webshop_elastic_search'
+        )
+        self.time = FakeTime()
+        self._multiprocessing, self._time = \
+            es_commands.multiprocessing, es_commands.time
+        es_commands.multiprocessing = InProcessMultiprocessing
+        es_commands.time = self.time
+
+    def tearDown(self):
+        es_commands.multiprocessing = self._multiprocessing
+        es_commands.time = self._time
+        self.clear_generations()
+
+    def clear_generations(self):
+        """
+        Delete the index generations, along with the alias of the index,
+        and the index created in place of the alias by the backlog.
+        """
+        with transaction(DB_NAME) as pool:
+            config = pool.get('elasticsearch.configuration')(1)
+            conn = config.get_es_connection()
+            for name in config.get_index_generations():
+                conn.indices.delete_index(name)
+            conn.indices.delete_index_if_exists(
+                config.get_index_name(name=None)
+            )
+
+    def get_alias(self):
+        """
+        Return the names of the indices the alias of the index points to.
+        """
+        with transaction(DB_NAME) as pool:
+            config = pool.get('elasticsearch.configuration')(1)
+            return config.get_es_connection().indices.get_alias(
+                config.get_index_name(name=None)
+            )
+
+    def get_index_version(self):
+        with transaction(DB_NAME) as pool:
+            Configuration = pool.get('elasticsearch.configuration')
+            return Configuration.get_index_version()
+
+    def test_0010_partition(self):
+        """
+        Test that the ids are split in contiguous ranges of equal size
+        which cover every id.
+        """
+        self.assertEqual(
+            partition(range(1, 101), 2), [(None, 51), (51, None)]
+        )
+        self.assertEqual(
+            partition(range(1, 11), 3), [(None, 5), (5, 9), (9, None)]
+        )
+        # Less ids than workers
+        self.assertEqual(
+            partition([4, 7], 4), [(None, 7), (7, None)]
+        )
+        self.assertEqual(partition([], 4), [(None, None)])
+
+        ranges = partition(range(1, 101, 3), 7)
+        for record_id in xrange(0, 200):
+            self.assertEqual(
+                len([r for r in ranges if in_range(record_id, *r)]), 1
+            )
+
+    def test_0020_partition_snapshot(self):
+        """
+        Test that the ranges of the workers do not depend on the records
+        created or deleted after the split.
+        """
+        ids = range(1, 101)
+        ranges = partition(ids, 2)
+
+        # Product 10 is deleted and 101 created after the split
+        later_ids = [i for i in ids if i != 10] + [101]
+        indexed = [
+            [i for i in later_ids if in_range(i, lo, hi)]
+            for lo, hi in ranges
+        ]
+        self.assertEqual(indexed[0], range(1, 10) + range(11, 51))
+        self.assertEqual(indexed[1], range(51, 102))
+
+    def test_0030_range_domain(self):
+        """
+        Test the domain of the ids of a range
+        """
+        self.assertEqual(get_range_domain(None, None), [])
+        self.assertEqual(get_range_domain(None, 51), [('id', '<', 51)])
+        self.assertEqual(
+            get_range_domain(51, 101), [('id', '>=', 51), ('id', '<', 101)]
+        )
+        self.assertEqual(get_range_domain(51, None), [('id', '>=', 51)])
+
+    def test_0040_transaction(self):
+        """
+        Test that the changes of a transaction are committed
+        """
+        with transaction(DB_NAME) as pool:
+            IndexBacklog = pool.get('elasticsearch.index_backlog')
+            entry, = IndexBacklog.create([{
+                'record_model': 'product.product',
+                'record_id': 999999,
+            }])
+        with transaction(DB_NAME) as pool:
+            IndexBacklog = pool.get('elasticsearch.index_backlog')
+            self.assertEqual(
+                IndexBacklog.search([('id', '=', entry.id)], count=True), 1
+            )
+            IndexBacklog.delete(IndexBacklog.browse([entry.id]))
+
+    def test_0050_reindex_worker_and_swap(self):
+        """
+        Test the steps of a rebuild, run in the calling process.
+        """
+        since = datetime.now()
+        self.assertEqual(_get_id_ranges(DB_NAME, 'admin', 2)[0][0], None)
+
+        index_name, settings = _create_index_generation(DB_NAME, 'admin')
+        result = _reindex_worker(
+            (DB_NAME, 'admin', 0, (None, None), 100, index_name)
+        )
+        self.assertEqual(result['worker'], 0)
+        self.assertEqual(result['products'], result['indexed'])
+        self.assertEqual(result['errors'], [])
+
+        _swap_index_alias(DB_NAME, 'admin', index_name, settings, 0, since)
+        self.assertEqual(self.get_alias(), [index_name])
+
+    def test_0060_reindex_and_rebuild(self):
+        """
+        Test the reindex and the rebuild of the whole catalog.
+        """
+        version = self.get_index_version()
+        result = reindex(DB_NAME, processes=2, chunk_size=100)
+        self.assertEqual(result['products'], result['indexed'])
+        self.assertEqual(result['errors'], [])
+        self.assertGreater(self.get_index_version(), version)
+
+        result = rebuild(DB_NAME, processes=2, chunk_size=100, keep=0)
+        self.assertTrue(result['swapped'])
+        self.assertEqual(self.get_alias(), [result['index']])
+
+        # Workers run in processes of their own
+        es_commands.multiprocessing = self._multiprocessing
+        self.assertEqual(
+            es_commands._run_in_process(sum, [1, 2, 3]), 6
+        )
+
+    def test_0065_rebuild_not_swapped(self):
+        """
+        Test that the new generation is deleted when the rebuild fails or
+        is not swapped.
+        """
+        def get_generations():
+            with transaction(DB_NAME) as pool:
+                config = pool.get('elasticsearch.configuration')(1)
+                return config.get_index_generations()
+
+        def failing_reindex(*args):
+            raise ValueError("Cluster unreachable")
+
+        def reindex_with_errors(*args):
+            return {
+                'products': 1, 'indexed': 0,
+                'errors': [{'id': 1, 'error': 'Rejected'}],
+            }
+
+        reindex = es_commands.reindex
+        try:
+            es_commands.reindex = failing_reindex
+            self.assertRaises(ValueError, rebuild, DB_NAME, processes=2)
+            self.assertEqual(get_generations(), [])
+
+            es_commands.reindex = reindex_with_errors
+            self.assertFalse(rebuild(DB_NAME, processes=2)['swapped'])
+            self.assertEqual(get_generations(), [])
+
+            self.assertEqual(main(['-d', DB_NAME, 'rebuild']), 1)
+            self.assertEqual(get_generations(), [])
+        finally:
+            es_commands.reindex = reindex
+
+    def test_0070_work(self):
+        """
+        Test that the worker drains the backlog, and survives failures.
+        """
+        with transaction(DB_NAME) as pool:
+            IndexBacklog = pool.get('elasticsearch.index_backlog')
+            IndexBacklog.create([{
+                'record_model': 'product.product',
+                'record_id': 999999,
+            }])
+
+        work(DB_NAME, throttle=Throttle(max_rate=100000), batches=2)
+        # The backlog was empty for the second batch
+        self.assertEqual(self.time.sleeps, [5])
+
+        with transaction(DB_NAME) as pool:
+            IndexBacklog = pool.get('elasticsearch.index_backlog')
+            self.assertEqual(IndexBacklog.search([], count=True), 0)
+
+        # No such user
+        throttle = Throttle(min_batch_size=10, backoff=0)
+        throttle.batch_size = 40
+        work(DB_NAME, login='nobody', throttle=throttle, batches=1)
+        self.assertEqual(throttle.batch_size, 20)
+
+    def test_0080_export_load_commands(self):
+        """
+        Test the export and the load commands
+        """
+        handle, path = tempfile.mkstemp(suffix='.ndjson')
+        os.close(handle)
+        try:
+            options = get_parser().parse_args([
+                '-d', DB_NAME, 'export', '-o', path,
+            ])
+            self.assertEqual(_export_command(options), 0)
+            with open(path) as source:
+                exported = source.read()
+
+            stdout, sys.stdout = sys.stdout, StringIO()
+            try:
+                options = get_parser().parse_args(['-d', DB_NAME, 'export'])
+                self.assertEqual(_export_command(options), 0)
+                self.assertEqual(sys.stdout.getvalue(), exported)
+            finally:
+                sys.stdout = stdout
+
+            index_name, _ = _create_index_generation(DB_NAME, 'admin')
+            with open(path, 'w') as output:
+                output.write(json.dumps({'id': 1, 'name': 'Loaded'}) + '\n')
+            options = get_parser().parse_args([
+                'load', '-i', path, '--index', index_name, '--bulk-settings',
+            ])
+            self.assertEqual(_load_command(options), 0)
+
+            # The cached search results expire when a database is given
+            version = self.get_index_version()
+            options = get_parser().parse_args([
+                '-d', DB_NAME, 'load', '-i', path, '--index', index_name,
+            ])
+            self.assertEqual(_load_command(options), 0)
+            self.assertGreater(self.get_index_version(), version)
+
+            stdin, sys.stdin = sys.stdin, StringIO(
+                json.dumps({'id': 2, 'name': 'Loaded'}) + '\n'
+            )
+            try:
+                options = get_parser().parse_args([
+                    'load', '--index', index_name,
+                ])
+                self.assertEqual(_load_command(options), 0)
+            finally:
+                sys.stdin = stdin
+
+            with transaction(DB_NAME) as pool:
+                config = pool.get('elasticsearch.configuration')(1)
+                conn = config.get_es_connection()
+                self.assertEqual(
+                    conn.count(indices=[index_name])['count'], 2
+                )
+        finally:
+            os.remove(path)
+
+    def test_0090_main(self):
+        """
+        Test the command line entry point
+        """
+        self.assertEqual(main(['-d', DB_NAME, 'reindex', '-p', '2']), 0)
+        self.assertEqual(
+            main(['-d', DB_NAME, 'rebuild', '-p', '2', '--keep', '0']), 0
+        )
+        self.assertEqual(len(self.get_alias()), 1)
+        self.assertEqual(main(['-d', DB_NAME, 'work', '--batches', '1']), None)
+
+        # A database is required but to load
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            self.assertRaises(SystemExit, main, ['reindex'])
+        finally:
+            sys.stderr = stderr
+
+
+def suite():
+    """
+    Define suite
+    """
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestCommands)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/test_indexer.py
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import unittest
+
+import indexer
+from indexer import Throttle
+
+
+class FakeTime(object):
+    """
+    Stands for the `time` module in `indexer`, recording the sleeps instead
+    of sleeping.
+    """
+
+    def __init__(self):
+        self.sleeps = []
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+    def time(self):
+        return 0
+
+
+def batch_stats(
+    entries, documents=None, rejected=0, requests=1, request_time=0.1
+):
+    return {
+        'entries': entries,
+        'documents': entries if documents is None else documents,
+        'rejected': rejected,
+        'requests': requests,
+        'request_time': request_time,
+    }
+
+
+class TestThrottle(unittest.TestCase):
+    "Test the pacing of the backlog drainer"
+
+    def setUp(self):
+        self.time = FakeTime()
+        self._time, indexer.time = indexer.time, self.time
+
+    def tearDown(self):
+        indexer.time = self._time
+
+    def get_throttle(self, batch_size=400):
+        throttle = Throttle(
+            max_rate=100000, min_batch_size=10, max_batch_size=1000,
+            target_latency=1.0, backoff=5
+        )
+        throttle.batch_size = batch_size
+        return throttle
+
+    def test_0010_rejected(self):
+        """
+        Test that the batch size is halved, with a pause, when items were
+        rejected.
+        """
+        throttle = self.get_throttle()
+        throttle.update(batch_stats(400, rejected=1), elapsed=10)
+        self.assertEqual(throttle.batch_size, 200)
+        self.assertEqual(self.time.sleeps, [5])
+
+        # Never below the minimum batch size
+        throttle.batch_size = 15
+        throttle.update(batch_stats(15, rejected=3), elapsed=10)
+        self.assertEqual(throttle.batch_size, 10)
+
+    def test_0020_latency(self):
+        """
+        Test that the batch size is halved when the average latency of the
+        requests exceeds the target.
+        """
+        throttle = self.get_throttle()
+        throttle.update(
+            batch_stats(400, requests=3, request_time=6.0), elapsed=10
+        )
+        self.assertEqual(throttle.batch_size, 200)
+        self.assertEqual(self.time.sleeps, [5])
+
+        # An average latency below the target is fine
+        throttle.update(
+            batch_stats(200, requests=3, request_time=2.4), elapsed=10
+        )
+        self.assertEqual(throttle.batch_size, 210)
+
+    def test_0030_growth(self):
+        """
+        Test that the batch size grows additively when a full batch is
+        accepted, and only then.
+        """
+        throttle = self.get_throttle()
+        throttle.update(batch_stats(400), elapsed=10)
+        self.assertEqual(throttle.batch_size, 410)
+        throttle.update(batch_stats(410), elapsed=10)
+        self.assertEqual(throttle.batch_size, 420)
+
+        # The backlog did not fill the batch
+        throttle.update(batch_stats(100), elapsed=10)
+        self.assertEqual(throttle.batch_size, 420)
+
+        # Never above the maximum batch size
+        throttle.batch_size = 995
+        throttle.update(batch_stats(995), elapsed=10)
+        self.assertEqual(throttle.batch_size, 1000)
+        self.assertEqual(self.time.sleeps, [])
+
+    def test_0040_max_rate(self):
+        """
+        Test that the drainer waits as long as needed to respect the
+        maximum rate.
+        """
+        throttle = self.get_throttle()
+        throttle.max_rate = 100
+
+        # 50 documents take at least half a second
+        throttle.update(batch_stats(400, documents=50), elapsed=0.1)
+        self.assertEqual(len(self.time.sleeps), 1)
+        self.assertAlmostEqual(self.time.sleeps[0], 0.4)
+
+        # The batch already took longer
+        throttle.update(batch_stats(400, documents=50), elapsed=1)
+        self.assertEqual(len(self.time.sleeps), 1)
+
+
+def suite():
+    """
+    Define suite
+    """
+    test_suite = unittest.TestSuite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestThrottle)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -5,7 +5,6 @@
     :copyright: (c) 2014-2015 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
-import time
 import datetime
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
@@ -17,6 +16,8 @@ from trytond.transaction import Transaction
 from trytond.config import CONFIG
 from nereid.testing import NereidTestCase
 from pagination import ElasticPagination
+from trytond.modules.nereid_webshop_elastic_search import \
+    pagination as es_pagination
 
 CONFIG['elastic_search_server'] = "http://localhost:9200"
 
@@ -34,6 +35,12 @@ class TestPagination(NereidTestCase):
             'nereid_webshop_elastic_search'
         )
 
+        # The results cached by the previous tests, whose transactions were
+        # rolled back, may be cached under the same index version (the
+        # website uses the copy of the module imported from its package)
+        ElasticPagination.result_cache.clear()
+        es_pagination.ElasticPagination.result_cache.clear()
+
         self.ProductTemplate = POOL.get('product.template')
         self.Uom = POOL.get('product.uom')
         self.ProductCategory = POOL.get('product.category')
@@ -354,7 +361,7 @@ class TestPagination(NereidTestCase):
                 }])
 
             self.IndexBacklog.update_index()
-            time.sleep(5)
+            self.ElasticConfig(1).refresh_and_wait()
 
             self.assertEqual(self.IndexBacklog.search([], count=True), 0)
 
@@ -370,3 +377,111 @@ class TestPagination(NereidTestCase):
             self.assertEqual(pagination.end_count, 10)
 
             self.clear_server()
+
+    def test_0020_result_cache(self):
+        """
+        Tests that the results are cached until the index changes
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.update_treenode_mapping()
+
+            uom, = self.Uom.search([('symbol', '=', 'u')])
+            template, = self.ProductTemplate.create([{
+                'name': 'GreatProduct',
+                'type': 'goods',
+                'default_uom': uom.id,
+                'list_price': Decimal(3000),
+                'cost_price': Decimal(2000),
+            }])
+            self.Product.create([{
+                'template': template.id,
+                'code': 'code_' + str(x),
+                'displayed_on_eshop': True,
+                'uri': 'prod_' + str(x)
+            } for x in range(0, 3)])
+
+            self.IndexBacklog.update_index()
+            self.ElasticConfig(1).refresh_and_wait()
+            version = self.ElasticConfig.get_index_version()
+
+            def paginate():
+                return ElasticPagination(
+                    self.Product.__name__,
+                    self.Product._quick_search_es('GreatProduct', filters={}),
+                    page=1, per_page=10, cache_key=['greatproduct', []]
+                )
+
+            pagination = paginate()
+            self.assertEqual(pagination.count, 3)
+            self.assertEqual(len(pagination.items()), 3)
+            self.assertIs(paginate().result_set, pagination.result_set)
+
+            self.Product.create([{
+                'template': template.id,
+                'code': 'code_3',
+                'displayed_on_eshop': True,
+                'uri': 'prod_3'
+            }])
+            self.IndexBacklog.update_index()
+            self.ElasticConfig(1).refresh_and_wait()
+
+            self.assertGreater(self.ElasticConfig.get_index_version(), version)
+            self.assertEqual(paginate().count, 4)
+
+            self.clear_server()
+
+    def test_0030_source_filtering(self):
+        """
+        Tests that only the requested fields of the documents are fetched
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.update_treenode_mapping()
+
+            uom, = self.Uom.search([('symbol', '=', 'u')])
+            template, = self.ProductTemplate.create([{
+                'name': 'GreatProduct',
+                'type': 'goods',
+                'default_uom': uom.id,
+                'description': 'This is a product',
+                'list_price': Decimal(3000),
+                'cost_price': Decimal(2000),
+            }])
+            product, = self.Product.create([{
+                'template': template.id,
+                'code': 'code_1',
+                'displayed_on_eshop': True,
+                'uri': 'prod_1'
+            }])
+
+            self.IndexBacklog.update_index()
+            self.ElasticConfig(1).refresh_and_wait()
+
+            search_obj = self.Product._quick_search_es(
+                'GreatProduct', filters={}
+            )
+
+            pagination = ElasticPagination(
+                self.Product.__name__, search_obj, page=1, per_page=10
+            )
+            hit, = pagination.result_set
+            self.assertEqual(hit.id, product.id)
+            self.assertIsNone(hit.description)
+            self.assertEqual(pagination.items(), [product])
+
+            pagination = ElasticPagination(
+                self.Product.__name__, search_obj, page=1, per_page=10,
+                fields=['id', 'name', 'code']
+            )
+            hit, = pagination.result_set
+            self.assertEqual(hit.name, 'GreatProduct')
+            self.assertEqual(hit.code, 'code_1')
+            self.assertIsNone(hit.description)
+
+            pagination = ElasticPagination(
+                self.Product.__name__, search_obj, page=1, per_page=10,
+                fields=None
+            )
+            hit, = pagination.result_set
+            self.assertEqual(hit.description, 'This is a product')
+
+            self.clear_server()
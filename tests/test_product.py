@@ -5,9 +5,12 @@
     :copyright: (c) 2014-2015 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import json
 import unittest
-import time
+import itertools
+import threading
 import datetime
+from StringIO import StringIO
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
 from pyes.managers import Indices
@@ -17,7 +20,13 @@ import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
 from trytond.transaction import Transaction
 from trytond.config import CONFIG
+from nereid import url_for
 from nereid.testing import NereidTestCase
+from indexer import BulkIndexer, scan_ids
+from es_commands import _delete_stale_documents, export_documents, load
+from autocomplete import PrefixIndex, normalize
+from trytond.modules.nereid_webshop_elastic_search import \
+    pagination as es_pagination, autocomplete as es_autocomplete
 
 CONFIG['elastic_search_server'] = "http://localhost:9200"
 
@@ -34,12 +43,17 @@ class TestProduct(NereidTestCase):
             'nereid_webshop_elastic_search'
         )
 
+        # The results cached by the previous tests, whose transactions were
+        # rolled back, may be cached under the same index version
+        es_pagination.ElasticPagination.result_cache.clear()
+
         self.ProductTemplate = POOL.get('product.template')
         self.Uom = POOL.get('product.uom')
         self.ProductCategory = POOL.get('product.category')
         self.Product = POOL.get('product.product')
         self.IndexBacklog = POOL.get('elasticsearch.index_backlog')
         self.PriceList = POOL.get('product.price_list')
+        self.PriceListLine = POOL.get('product.price_list.line')
         self.Party = POOL.get('party.party')
         self.Company = POOL.get('company.company')
         self.User = POOL.get('res.user')
@@ -486,7 +500,7 @@ class TestProduct(NereidTestCase):
 
             # Update index on Elastic-Search server
             self.IndexBacklog.update_index()
-            time.sleep(2)
+            self.ElasticConfig(1).refresh_and_wait()
 
             # Test if new records have been uploaded on elastic server
             # If Index Backlog if empty, it means the records got updated
@@ -505,7 +519,7 @@ class TestProduct(NereidTestCase):
             app = self.get_app()
 
             self.IndexBacklog.update_index()
-            time.sleep(5)
+            self.ElasticConfig(1).refresh_and_wait()
 
             with app.test_request_context('/'):
                 results = self.NereidWebsite.auto_complete('product')
@@ -534,7 +548,7 @@ class TestProduct(NereidTestCase):
             self.setup_defaults()
             self.create_products()
             self.IndexBacklog.update_index()
-            time.sleep(5)
+            self.ElasticConfig(1).refresh_and_wait()
             app = self.get_app()
 
             with app.test_client() as c:
@@ -561,7 +575,7 @@ class TestProduct(NereidTestCase):
             self.setup_defaults()
             self.create_products()
             self.IndexBacklog.update_index()
-            time.sleep(5)
+            self.ElasticConfig(1).refresh_and_wait()
             app = self.get_app()
 
             with app.test_client() as c:
@@ -648,7 +662,7 @@ class TestProduct(NereidTestCase):
             self.assertEqual(self.IndexBacklog.search([], count=True), 1)
 
             self.IndexBacklog.update_index()
-            time.sleep(2)
+            self.ElasticConfig(1).refresh_and_wait()
 
             self.assertEqual(self.IndexBacklog.search([], count=True), 0)
 
@@ -750,7 +764,7 @@ class TestProduct(NereidTestCase):
             }])
 
             self.IndexBacklog.update_index()
-            time.sleep(2)
+            self.ElasticConfig(1).refresh_and_wait()
 
             with app.test_request_context('/search?q=SomeProductCode'):
                 facets = self.NereidWebsite.quick_search().context['facets']
@@ -853,7 +867,7 @@ class TestProduct(NereidTestCase):
             }])
 
             self.IndexBacklog.update_index()
-            time.sleep(2)
+            self.ElasticConfig(1).refresh_and_wait()
 
             with app.test_client() as c:
                 # No result search
@@ -935,6 +949,994 @@ class TestProduct(NereidTestCase):
                     ]
                 )
 
+    def test_0060_price_list_matrix(self):
+        """
+        Test that the price list matrix matches the prices computed by each
+        price list for each product.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            products = self.create_products()
+
+            price_lists = self.PriceList.search([])
+            matrix = self.Product.get_price_list_matrix(products)
+
+            self.assertEqual(set(matrix.keys()), set(p.id for p in products))
+            for product in products:
+                self.assertEqual(matrix[product.id], [{
+                    'id': _list.id,
+                    'price': _list.compute(
+                        self.company.party, product, product.list_price, 1,
+                        product.default_uom
+                    )
+                } for _list in price_lists])
+                self.assertEqual(
+                    product.elastic_search_json()['price_lists'],
+                    matrix[product.id]
+                )
+
+    def test_0065_elastic_search_json_batch(self):
+        """
+        Test that products are serialized in batch, in the order given.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            products = self.create_products()
+
+            documents = self.Product.elastic_search_json_batch(
+                list(reversed(products))
+            )
+
+            self.assertEqual(
+                [d['id'] for d in documents],
+                [p.id for p in reversed(products)]
+            )
+            for product, document in zip(reversed(products), documents):
+                self.assertEqual(document['name'], product.name)
+                self.assertEqual(document['code'], product.code)
+                self.assertEqual(
+                    document['description'], product.template.description
+                )
+                self.assertEqual(document['list_price'], product.list_price)
+                self.assertEqual(document['category'], {
+                    'id': product.category.id,
+                    'name': product.category.name,
+                })
+                self.assertEqual(
+                    document['active'],
+                    "true" if product.active else "false"
+                )
+                self.assertEqual(document['uri'], product.uri)
+                self.assertEqual(document['image'], {})
+                if product.active and product.displayed_on_eshop:
+                    self.assertEqual(document['suggest']['payload'], {
+                        'id': product.id,
+                        'uri': product.uri,
+                    })
+                else:
+                    self.assertNotIn('suggest', document)
+
+            self.assertEqual(
+                self.Product.elastic_search_suggest_inputs(
+                    'Blue Cotton Shirt', 'BCS-1'
+                ),
+                ['Blue Cotton Shirt', 'Cotton Shirt', 'Shirt', 'BCS-1']
+            )
+
+    def test_0070_template_write_change_detection(self):
+        """
+        Test that only writes to the fields of the search document add the
+        products to the backlog.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.create_products()
+            self.IndexBacklog.delete(self.IndexBacklog.search([]))
+
+            self.ProductTemplate.write([self.template1], {
+                'cost_price': 1000,
+            })
+            self.assertEqual(self.IndexBacklog.search([], count=True), 0)
+
+            self.ProductTemplate.write(
+                [self.template1], {'cost_price': 900},
+                [self.template2], {'name': 'Renamed Product 2'},
+            )
+            backlog = self.IndexBacklog.search([])
+            self.assertEqual(
+                [(b.record_model, b.record_id) for b in backlog],
+                [('product.product', self.template2.products[0].id)]
+            )
+
+    def test_0075_backlog_coalescing(self):
+        """
+        Test that repeated writes keep a single backlog entry per product.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            products = self.create_products()
+            self.IndexBacklog.delete(self.IndexBacklog.search([]))
+
+            for x in range(0, 5):
+                self.ProductTemplate.write([self.template1], {
+                    'name': 'Product 1 v%d' % x,
+                })
+            self.IndexBacklog.create_from_records(products + products)
+
+            self.assertEqual(
+                self.IndexBacklog.search([], count=True), len(products)
+            )
+
+    def test_0080_bulk_index(self):
+        """
+        Test that products are indexed with `_bulk` requests.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.update_treenode_mapping()
+            self.setup_defaults()
+            products = self.create_products()
+
+            indexer = self.Product.elastic_search_bulk_index(
+                products, chunk_size=2
+            )
+            self.ElasticConfig(1).refresh_and_wait()
+
+            self.assertEqual(indexer.errors, [])
+            self.assertEqual(indexer.succeeded, len(products))
+
+            conn = self.ElasticConfig(1).get_es_connection()
+            results = conn.search(
+                BoolQuery(must=[MatchQuery('code', 'code1')]),
+                doc_types=[
+                    self.ElasticConfig(1).make_type_name('product.product')
+                ]
+            )
+            self.assertEqual(results.count(), 1)
+
+            self.clear_server()
+
+    def test_0085_index_generations(self):
+        """
+        Test rebuilding the products into a new index generation and swapping
+        the alias to it.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            products = self.create_products()
+            config = self.ElasticConfig(1)
+            conn = config.get_es_connection()
+            indices = Indices(conn)
+            self.clear_server()
+
+            first = config.create_index_generation()
+            self.Product.elastic_search_bulk_index(
+                products, indexer=BulkIndexer.from_config(
+                    'product.product', index_name=first
+                )
+            )
+            config.swap_index_alias(first)
+            self.assertEqual(
+                indices.get_alias(config.get_index_name(name=None)), [first]
+            )
+
+            second = config.create_index_generation()
+            config.swap_index_alias(second, keep=0)
+            self.assertEqual(
+                indices.get_alias(config.get_index_name(name=None)), [second]
+            )
+            self.assertEqual(config.get_index_generations(), [second])
+
+            # A generation left by a rebuild which was not swapped is not a
+            # rollback target
+            orphan = config.create_index_generation()
+            third = config.create_index_generation()
+            config.swap_index_alias(third, keep=1)
+            self.assertEqual(
+                indices.get_alias(config.get_index_name(name=None)), [third]
+            )
+            self.assertNotIn(orphan, config.get_index_generations())
+            self.assertEqual(config.get_index_generations(), [second, third])
+
+            indices.delete_index_if_exists(second)
+            indices.delete_index_if_exists(third)
+
+    def test_0090_sync_changes(self):
+        """
+        Test that products whose category changed outside of the backlog are
+        added to it by the synchronisation.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            products = self.create_products()
+
+            uom, = self.Uom.search([('symbol', '=', 'u')])
+            other_category, = self.ProductCategory.create([{
+                'name': 'Other Category',
+                'uri': 'other-category',
+            }])
+            other_template, = self.ProductTemplate.create([{
+                'name': 'Other Product',
+                'type': 'goods',
+                'category': other_category.id,
+                'default_uom': uom.id,
+                'list_price': 3000,
+                'cost_price': 2000,
+            }])
+            other_product, = self.Product.create([{
+                'template': other_template.id,
+                'code': 'code of other product',
+                'displayed_on_eshop': True,
+                'uri': 'otherprod',
+            }])
+
+            # Pretend the records were created long before the watermark,
+            # so that only the changes of the dependencies match
+            cursor = Transaction().cursor
+            past = datetime.datetime.now() - datetime.timedelta(days=1)
+            for model_name in ['product.product'] + \
+                    self.Product.get_elastic_search_dependencies().keys():
+                cursor.execute(
+                    'UPDATE "%s" SET create_date = %%s, write_date = NULL'
+                    % POOL.get(model_name)._table, (past,)
+                )
+
+            # The first synchronisation only sets the watermark
+            self.IndexBacklog.delete(self.IndexBacklog.search([]))
+            self.IndexBacklog.sync_changes()
+            self.assertEqual(self.IndexBacklog.search([], count=True), 0)
+            self.assertTrue(self.ElasticConfig(1).sync_watermark)
+
+            self.ProductCategory.write([self.template1.category], {
+                'name': 'Renamed Category',
+            })
+            self.IndexBacklog.sync_changes()
+
+            # Only the products of the renamed category, inactive included
+            enqueued = set(b.record_id for b in self.IndexBacklog.search([
+                ('record_model', '=', 'product.product'),
+            ]))
+            self.assertEqual(enqueued, set(p.id for p in products))
+            self.assertNotIn(other_product.id, enqueued)
+
+    def test_0095_price_updates(self):
+        """
+        Test that price changes only update the prices of the documents.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.update_treenode_mapping()
+            self.setup_defaults()
+            product = self.create_products()[0]
+            self.IndexBacklog.update_index()
+
+            # The fields which are not indexed do not matter
+            self.ProductTemplate.write([self.template1], {
+                'list_price': Decimal('1234'),
+                'cost_price': Decimal('1000'),
+            })
+            self.assertEqual(
+                [(b.record_model, b.record_id)
+                    for b in self.IndexBacklog.search([])],
+                [('product.template', self.template1.id)]
+            )
+
+            self.IndexBacklog.update_index()
+            self.ElasticConfig(1).refresh_and_wait()
+            self.assertEqual(self.IndexBacklog.search([], count=True), 0)
+
+            conn = self.ElasticConfig(1).get_es_connection()
+            document = conn.get(
+                self.ElasticConfig(1).get_index_name(name=None),
+                self.ElasticConfig(1).make_type_name('product.product'),
+                product.id
+            )
+            self.assertEqual(document['list_price'], 1234)
+            self.assertEqual(document['code'], product.code)
+
+            self.clear_server()
+
+    def test_0100_document_hash(self):
+        """
+        Test that unchanged documents are not sent again.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.update_treenode_mapping()
+            self.setup_defaults()
+            products = [p for p in self.create_products() if p.active]
+            self.IndexBacklog.update_index()
+
+            DocumentHash = POOL.get('elasticsearch.document_hash')
+            self.assertEqual(
+                DocumentHash.search([], count=True), len(products)
+            )
+
+            indexer = BulkIndexer.from_config('product.product')
+            self.IndexBacklog._index_records(
+                indexer, 'product.product', set(p.id for p in products)
+            )
+            self.assertEqual(indexer.succeeded, 0)
+
+            self.ProductTemplate.write([self.template1], {
+                'name': 'Changed Product',
+            })
+            indexer = BulkIndexer.from_config('product.product')
+            self.IndexBacklog._index_records(
+                indexer, 'product.product', set(p.id for p in products)
+            )
+            self.assertEqual(indexer.succeeded, 1)
+
+            # An index created again has no digests, all its documents are
+            # sent
+            self.clear_server()
+            self.update_treenode_mapping()
+            indexer = BulkIndexer.from_config('product.product')
+            self.IndexBacklog._index_records(
+                indexer, 'product.product', set(p.id for p in products)
+            )
+            self.assertEqual(indexer.succeeded, len(products))
+            self.assertEqual(
+                DocumentHash.search([
+                    ('index_key', '=', indexer.index_key),
+                ], count=True), len(products)
+            )
+
+            self.clear_server()
+
+    def test_0105_product_hooks(self):
+        """
+        Test that product writes and deletes update the index.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.update_treenode_mapping()
+            self.setup_defaults()
+            product = self.create_products()[0]
+            self.IndexBacklog.update_index()
+            self.assertEqual(self.IndexBacklog.search([], count=True), 0)
+
+            self.Product.write([product], {'code': 'changed code'})
+            self.assertEqual(self.IndexBacklog.search([], count=True), 1)
+            self.IndexBacklog.update_index()
+
+            product_id = product.id
+            self.Product.delete([product])
+            backlog, = self.IndexBacklog.search([])
+            self.assertEqual(backlog.record_id, product_id)
+
+            self.IndexBacklog.update_index()
+            self.ElasticConfig(1).refresh_and_wait()
+            self.assertEqual(self.IndexBacklog.search([], count=True), 0)
+
+            conn = self.ElasticConfig(1).get_es_connection()
+            results = conn.search(
+                BoolQuery(must=[MatchQuery('code', 'changed code')]),
+                doc_types=[
+                    self.ElasticConfig(1).make_type_name('product.product')
+                ]
+            )
+            self.assertEqual(results.count(), 0)
+
+            self.clear_server()
+
+    def test_0110_category_rename(self):
+        """
+        Test that renaming a category updates the documents of its products.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.update_treenode_mapping()
+            self.setup_defaults()
+            product = self.create_products()[0]
+            self.IndexBacklog.update_index()
+
+            category = self.template1.category
+            self.ProductCategory.write([category], {
+                'name': 'Renamed Category',
+            })
+            self.assertEqual(
+                [(b.record_model, b.record_id)
+                    for b in self.IndexBacklog.search([])],
+                [('product.category', category.id)]
+            )
+
+            self.IndexBacklog.update_index()
+            self.ElasticConfig(1).refresh_and_wait()
+
+            conn = self.ElasticConfig(1).get_es_connection()
+            document = conn.get(
+                self.ElasticConfig(1).get_index_name(name=None),
+                self.ElasticConfig(1).make_type_name('product.product'),
+                product.id
+            )
+            self.assertEqual(document['category'], {
+                'id': category.id,
+                'name': 'Renamed Category',
+            })
+
+            self.clear_server()
+
+    def test_0115_backlog_lock_batch(self):
+        """
+        Test that the drainers take the most recent backlog entries with the
+        other entries of their records, which are coalesced.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.update_treenode_mapping()
+            self.setup_defaults()
+            products = self.create_products()
+            self.IndexBacklog.delete(self.IndexBacklog.search([]))
+            self.IndexBacklog.create_from_records(products)
+
+            # An entry enqueued by another transaction
+            self.IndexBacklog.create([{
+                'record_model': 'product.product',
+                'record_id': products[0].id,
+            }])
+            self.IndexBacklog.create_from_records(products)
+            self.assertEqual(
+                self.IndexBacklog.search([], count=True), len(products) + 1
+            )
+
+            entries = self.IndexBacklog.lock_batch(2)
+            self.assertEqual(len(entries), 3)
+            self.assertEqual(
+                set(entry.record_id for entry in entries),
+                set([products[0].id, products[-1].id])
+            )
+
+            stats = self.IndexBacklog.update_index(2)
+            self.assertEqual(stats['entries'], 3)
+            self.assertEqual(stats['documents'], 2)
+            self.assertEqual(
+                sorted(b.record_id for b in self.IndexBacklog.search([])),
+                sorted(product.id for product in products[1:-1])
+            )
+
+            self.clear_server()
+
+    def test_0120_filterable_attributes_cache(self):
+        """
+        Test that the filterable attributes are cached and that the cache is
+        cleared when an attribute changes.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            attribute, = self.ProductAttribute.create([{
+                'name': 'size',
+                'type_': 'selection',
+                'string': 'Size',
+                'selection': 'm: M\nl:L\nxl:XL'
+            }])
+
+            attributes = self.Product.get_filterable_attributes()
+            self.assertEqual([a.name for a in attributes], ['size'])
+            self.assertTrue(attributes[0].multiselect)
+            self.assertIs(self.Product.get_filterable_attributes(), attributes)
+
+            self.ProductAttribute.write([attribute], {
+                'multiselect': False,
+            })
+            attributes = self.Product.get_filterable_attributes()
+            self.assertFalse(attributes[0].multiselect)
+
+            self.assertEqual(
+                self.ProductAttribute.get_display_count_names(), frozenset()
+            )
+            self.ProductAttribute.write([attribute], {
+                'display_count': True,
+            })
+            self.assertEqual(
+                self.Product.add_display_counts({'size': {}, 'color': {}}),
+                {
+                    'size': {'display_count': True},
+                    'color': {'display_count': False},
+                }
+            )
+
+            self.ProductAttribute.write([attribute], {
+                'filterable': False,
+            })
+            self.assertEqual(self.Product.get_filterable_attributes(), ())
+            self.assertEqual(
+                self.ProductAttribute.get_display_count_names(), frozenset()
+            )
+
+            # The values of the attributes are stored on the products, the
+            # documents do not change
+            self.IndexBacklog.delete(self.IndexBacklog.search([]))
+            self.ProductAttribute.write([attribute], {
+                'string': 'Shirt Size',
+                'selection': 'm: M\nl:L\nxl:XL\nxxl:XXL',
+            })
+            self.assertEqual(self.IndexBacklog.search([], count=True), 0)
+
+    def test_0125_compiled_filters(self):
+        """
+        Test that the same filters in any order share one compiled filter.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            for name in ('size', 'color'):
+                self.ProductAttribute.create([{
+                    'name': name,
+                    'type_': 'char',
+                    'string': name.capitalize(),
+                }])
+            attributes = self.Product.get_filterable_attributes()
+
+            self.assertIsNone(
+                self.Product._build_es_filter(attributes, {'q': 'shirt'})
+            )
+
+            es_filter = self.Product._build_es_filter(attributes, {
+                'size': ['xl', 'l', 'xl'],
+                'color': 'blue',
+                'q': 'shirt',
+            })
+            self.assertEqual(
+                es_filter.key,
+                (('color', ('blue',)), ('size', ('l', 'xl')))
+            )
+            self.assertEqual(es_filter.serialize(), {
+                'bool': {
+                    'must': [{
+                        'and': [
+                            {'or': [{'term': {'color': 'blue'}}]},
+                            {'or': [
+                                {'term': {'size': 'l'}},
+                                {'term': {'size': 'xl'}},
+                            ]},
+                        ],
+                    }],
+                },
+            })
+
+            other_filter = self.Product._build_es_filter(attributes, {
+                'color': ['blue'],
+                'size': ['l', 'xl'],
+            })
+            self.assertIs(other_filter.serialize(), es_filter.serialize())
+
+            app = self.get_app()
+            with app.test_request_context('/search?size=xl&size=l&color=blue'):
+                self.assertEqual(
+                    self.Product._build_es_filter(attributes).key,
+                    es_filter.key
+                )
+
+    def test_0130_autocomplete_search_urls(self):
+        """
+        Test that the autocompletion with the full search builds the URLs
+        from the documents.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.update_treenode_mapping()
+            self.setup_defaults()
+            self.create_products()
+            app = self.get_app()
+
+            self.IndexBacklog.update_index()
+            self.ElasticConfig(1).refresh_and_wait()
+
+            with app.test_request_context('/'):
+                product_url = self.Product._es_product_url_builder()
+                product = self.template1.products[0]
+                self.assertEqual(
+                    product_url(product.uri),
+                    product.get_absolute_url(_external=True)
+                )
+
+                results = self.Product._es_autocomplete_search('product')
+                self.assertIn({
+                    'display_name': self.template1.name,
+                    'url': product.get_absolute_url(_external=True),
+                }, results)
+
+            self.clear_server()
+
+    def test_0135_prefix_index(self):
+        """
+        Test the autocompletion from the in-process prefix index.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.update_treenode_mapping()
+            self.setup_defaults()
+            self.create_products()
+            app = self.get_app()
+
+            self.IndexBacklog.update_index()
+            self.ElasticConfig(1).refresh_and_wait()
+
+            self.assertEqual(normalize(u' Prøduçt  1 '), u'prøduct 1')
+
+            config = self.ElasticConfig(1)
+            index = PrefixIndex(
+                config.get_es_connection(), config.get_index_name(name=None),
+                config.make_type_name('product.product')
+            )
+            index.refresh(self.ElasticConfig.get_index_version())
+
+            product = self.template2.products[0]
+            self.assertIn({
+                'id': product.id,
+                'display_name': self.template2.name,
+                'uri': product.uri,
+            }, index.search('produc'))
+            self.assertEqual(index.search('nothing like this'), [])
+            for result in index.search('product', size=100):
+                self.assertTrue(self.Product(result['id']).active)
+
+            CONFIG['elastic_search_prefix_index'] = True
+            es_autocomplete._indices.clear()
+            try:
+                with app.test_request_context('/'):
+                    suggestion = {
+                        'display_name': self.template2.name,
+                        'url': product.get_absolute_url(_external=True),
+                    }
+                    # Elasticsearch answers until the index is built in the
+                    # background
+                    self.assertIn(
+                        suggestion, self.NereidWebsite.auto_complete(
+                            'product 2'
+                        )
+                    )
+                    index = self.Product._get_prefix_index()
+                    index.wait_refresh()
+                    self.assertTrue(index.ready)
+                    self.assertEqual(
+                        self.Product._prefix_autocomplete('product 2'),
+                        [suggestion]
+                    )
+            finally:
+                CONFIG['elastic_search_prefix_index'] = False
+                es_autocomplete._indices.clear()
+
+            self.clear_server()
+
+    def test_0140_render_from_index(self):
+        """
+        Test that the search results are built from the documents, with the
+        price of the price list of the visitor and the URL of the image.
+        """
+        StaticFolder = POOL.get('nereid.static.folder')
+        StaticFile = POOL.get('nereid.static.file')
+        ImageSet = POOL.get('product.product.imageset')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.update_treenode_mapping()
+            self.setup_defaults()
+            self.create_products()
+            app = self.get_app()
+
+            folder, = StaticFolder.create([{'folder_name': 'images'}])
+            image, = StaticFile.create([{
+                'name': 'shirt.png',
+                'folder': folder.id,
+                'type': 'remote',
+                'remote_path': 'http://example.com/shirt.png',
+            }])
+            product = self.template1.products[0]
+            ImageSet.create([{
+                'name': 'Front',
+                'template': self.template1.id,
+                'image': image.id,
+            }])
+
+            document, = self.Product.elastic_search_json_batch([product])
+            self.assertEqual(
+                document['image'], {'url': 'http://example.com/shirt.png'}
+            )
+
+            self.IndexBacklog.update_index()
+            self.ElasticConfig(1).refresh_and_wait()
+
+            with app.test_request_context('/search?q=%s' % product.code):
+                CONFIG['elastic_search_render_from_index'] = True
+                try:
+                    result = self.NereidWebsite.quick_search()
+                finally:
+                    CONFIG['elastic_search_render_from_index'] = False
+
+                hits = dict(
+                    (hit.id, hit) for hit in result.context['products'].items()
+                )
+                hit = hits[product.id]
+                self.assertNotIsInstance(hit, self.Product)
+                self.assertEqual(hit.name, product.name)
+                self.assertEqual(hit.code, product.code)
+                self.assertEqual(hit.sale_price(), product.sale_price())
+                self.assertEqual(
+                    hit.get_absolute_url(),
+                    product.get_absolute_url(_external=True)
+                )
+                self.assertEqual(
+                    hit.image_url, 'http://example.com/shirt.png'
+                )
+
+                image_url = self.Product._es_image_url_builder()
+                self.assertEqual(
+                    image_url({'folder': 'images', 'name': 'shirt.png'}),
+                    url_for(
+                        'nereid.static.file.send_static_file',
+                        folder='images', name='shirt.png'
+                    )
+                )
+                self.assertIsNone(image_url({}))
+
+            self.clear_server()
+
+    def test_0145_delete_stale_documents(self):
+        """
+        Test that the products deleted or deactivated during a rebuild are
+        deleted from the new generation.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            products = self.create_products()
+            config = self.ElasticConfig(1)
+            conn = config.get_es_connection()
+            self.clear_server()
+
+            index_name = config.create_index_generation()
+            indexer = BulkIndexer.from_config(
+                'product.product', index_name=index_name
+            )
+            self.Product.elastic_search_bulk_index(products, indexer=indexer)
+            config.refresh_and_wait(index_name)
+
+            inactive, = [p for p in products if not p.active]
+            deleted = products[1]
+            deleted_id = deleted.id
+            self.Product.delete([deleted])
+
+            self.assertEqual(
+                sorted(_delete_stale_documents(POOL, index_name)),
+                sorted([deleted_id, inactive.id])
+            )
+            self.assertEqual(
+                sorted(scan_ids(conn, index_name, indexer.doc_type)),
+                sorted(
+                    p.id for p in products
+                    if p.id not in (deleted_id, inactive.id)
+                )
+            )
+
+            Indices(conn).delete_index_if_exists(index_name)
+
+    def test_0150_export_load(self):
+        """
+        Test that the exported documents are loaded into another index.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.update_treenode_mapping()
+            self.setup_defaults()
+            products = self.create_products()
+            config = self.ElasticConfig(1)
+            conn = config.get_es_connection()
+            doc_type = config.make_type_name('product.product')
+
+            output = StringIO()
+            # Less products per chunk than in the catalog, to read several
+            # pages of ids
+            count = export_documents(output, chunk_size=2)
+            active_products = [p for p in products if p.active]
+            self.assertEqual(count, len(active_products))
+
+            documents = [
+                json.loads(line) for line in output.getvalue().splitlines()
+            ]
+            self.assertEqual(
+                [d['id'] for d in documents],
+                sorted(p.id for p in active_products)
+            )
+
+            index_name = config.get_index_name(name=None) + '_scratch'
+            indices = Indices(conn)
+            indices.delete_index_if_exists(index_name)
+            indices.create_index(index_name)
+            try:
+                indexer = load(
+                    conn, StringIO(output.getvalue()), index_name, doc_type,
+                    chunk_size=2
+                )
+                self.assertEqual(indexer.errors, [])
+                self.assertEqual(indexer.succeeded, count)
+                self.assertEqual(
+                    conn.count(indices=[index_name])['count'], count
+                )
+
+                product = active_products[0]
+                document = conn.get(index_name, doc_type, product.id)
+                self.assertEqual(document['name'], product.name)
+                self.assertEqual(document['code'], product.code)
+                self.assertEqual(document['uri'], product.uri)
+            finally:
+                indices.delete_index_if_exists(index_name)
+
+            self.clear_server()
+
+    def test_0155_prefix_index_concurrent_refresh(self):
+        """
+        Test that the searches running while the prefix index is refreshed
+        see either the previous or the new state of the index.
+        """
+        catalogs = [
+            [(i, {'uri': 'apple-%d' % i, 'suggest': {
+                'input': ['apple %d' % i], 'output': 'apple %d' % i,
+            }}) for i in xrange(1, 201)],
+            [(i, {'uri': 'banana-%d' % i, 'suggest': {
+                'input': ['banana %d' % i], 'output': 'banana %d' % i,
+            }}) for i in xrange(1, 1001)],
+        ]
+
+        index = PrefixIndex(None, 'webshop', 'product_product')
+        index.min_refresh_interval = 0
+        index.full_refresh_interval = -1
+        scans = itertools.cycle(catalogs)
+        index._scan = lambda filter=None: iter(next(scans))
+
+        done = threading.Event()
+
+        def refresh():
+            version = 0
+            while not done.is_set():
+                version += 1
+                index.refresh(version)
+        index.refresh(0)
+
+        refresher = threading.Thread(target=refresh)
+        refresher.start()
+        try:
+            for _ in xrange(5000):
+                for prefix in ('apple', 'banana'):
+                    for result in index.search(prefix, size=20):
+                        self.assertTrue(
+                            result['display_name'].startswith(prefix)
+                        )
+                        self.assertEqual(
+                            result['uri'], result['display_name'].replace(
+                                ' ', '-'
+                            )
+                        )
+        finally:
+            done.set()
+            refresher.join()
+
+    def test_0160_price_list_matrix_variants(self):
+        """
+        Test that the variants of a template share the prices computed by
+        the price lists which have no product specific line.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.create_products()
+            variant, = self.Product.create([{
+                'template': self.template1.id,
+                'code': 'code1-variant',
+                'displayed_on_eshop': True,
+                'uri': 'prod1-variant',
+            }])
+            product, = [p for p in self.template1.products if p != variant]
+            price_lists = self.PriceList.search([])
+
+            computed = []
+            compute = self.PriceList.compute
+
+            def counting_compute(price_list, party, product, *args):
+                computed.append((price_list.id, product.id))
+                return compute(price_list, party, product, *args)
+
+            self.PriceList.compute = counting_compute
+            try:
+                matrix = self.Product.get_price_list_matrix([product, variant])
+                self.assertEqual(len(computed), len(price_lists))
+                self.assertEqual(matrix[product.id], matrix[variant.id])
+
+                # A line for the variant makes its price specific
+                self.PriceListLine.create([{
+                    'price_list': price_lists[0].id,
+                    'product': variant.id,
+                    'formula': 'unit_price * 2',
+                    'sequence': 1,
+                }])
+                price_lists = self.PriceList.search([])
+                del computed[:]
+                matrix = self.Product.get_price_list_matrix([product, variant])
+                self.assertEqual(len(computed), len(price_lists) + 1)
+            finally:
+                del self.PriceList.compute
+
+            self.assertEqual(
+                matrix[variant.id][0]['price'], variant.list_price * 2
+            )
+            self.assertEqual(
+                matrix[product.id][0]['price'],
+                price_lists[0].compute(
+                    self.company.party, product, product.list_price, 1,
+                    product.default_uom
+                )
+            )
+
+    def test_0165_elastic_search_json_override(self):
+        """
+        Test that an extension of `elastic_search_json` is used to build the
+        documents of the batches.
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            products = self.create_products()
+
+            elastic_search_json = self.Product.elastic_search_json
+
+            def extended_json(product):
+                document = elastic_search_json(product)
+                document['extra'] = product.code.upper()
+                return document
+
+            self.Product.elastic_search_json = extended_json
+            try:
+                documents = self.Product.elastic_search_json_batch(products)
+                exported = list(
+                    self.Product.elastic_search_documents(chunk_size=2)
+                )
+            finally:
+                del self.Product.elastic_search_json
+
+            self.assertEqual(
+                [d['extra'] for d in documents],
+                [p.code.upper() for p in products]
+            )
+            self.assertTrue(all('extra' in d for d in exported))
+            self.assertNotIn(
+                'extra', self.Product.elastic_search_json_batch(products)[0]
+            )
+
+    def test_0170_prefix_index_background_refresh(self):
+        """
+        Test that the prefix index is refreshed by a single background
+        thread, which logs its errors.
+        """
+        class Logger(object):
+            def __init__(self):
+                self.warnings = []
+
+            def warning(self, message, exc_info=False):
+                self.warnings.append(message)
+
+        logger = Logger()
+        started, release = threading.Event(), threading.Event()
+
+        def scan(filter=None):
+            started.set()
+            release.wait()
+            return iter([(1, {'uri': 'apple', 'suggest': {
+                'input': ['apple'], 'output': 'Apple',
+            }})])
+
+        index = PrefixIndex(None, 'webshop', 'product_product')
+        index._scan = scan
+        self.assertFalse(index.ready)
+
+        thread = index.refresh_in_background(1, logger)
+        started.wait()
+        self.assertIsNone(index.refresh_in_background(1, logger))
+        self.assertFalse(index.ready)
+        self.assertEqual(index.search('app'), [])
+
+        release.set()
+        index.wait_refresh()
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(index.ready)
+        self.assertEqual(
+            [result['id'] for result in index.search('app')], [1]
+        )
+        self.assertIsNone(index.refresh_in_background(1, logger))
+
+        def failing_scan(filter=None):
+            raise ValueError("Cluster unreachable")
+        index._scan = failing_scan
+        index.min_refresh_interval = 0
+        index.refresh_in_background(2, logger)
+        index.wait_refresh()
+        self.assertEqual(len(logger.warnings), 1)
+        self.assertEqual(index.version, 1)
+
 
 def suite():
     """
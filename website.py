@@ -6,6 +6,7 @@
     :license: GPLv3, see LICENSE for more details
 
 '''
+from trytond.config import CONFIG
 from trytond.pool import Pool, PoolMeta
 from nereid import request, route, render_template
 from pagination import ElasticPagination
@@ -23,9 +24,15 @@ class Website:
         """
         This is a downstream implementation which uses elasticsearch to return
         results for a query.
+
+        The in-process prefix index answers first when it is enabled, see
+        `product.product._prefix_autocomplete`.
         """
         Product = Pool().get('product.product')
 
+        results = Product._prefix_autocomplete(phrase)
+        if results is not None:
+            return results
         return Product._es_autocomplete(phrase)
 
     @classmethod
@@ -34,6 +41,13 @@ class Website:
         """
         This version of quick_search uses elasticsearch to build
         search results for searches from the website.
+
+        With the `elastic_search_render_from_index` option of the
+        configuration file, the products listed are built from their
+        documents instead of being read from the database (see
+        `product.product.elastic_search_hits`), so the template of the
+        results can only use the name, code, price, URL and image URL of
+        the products.
         """
         Product = Pool().get('product.product')
 
@@ -45,7 +59,14 @@ class Website:
         search_obj = Product._quick_search_es(phrase)
 
         products = ElasticPagination(
-            Product.__name__, search_obj, page, Product.per_page
+            Product.__name__, search_obj, page, Product.per_page,
+            cache_key=[
+                ' '.join(phrase.lower().split()),
+                Product._normalize_es_filters(
+                    Product.get_filterable_attributes()
+                ),
+            ],
+            hydrate=not CONFIG.get('elastic_search_render_from_index')
         )
 
         if products: